@@ -6,3 +6,72 @@ GRUPO_USERNAME = "tugrupo" #sin el @ y https://t.me/
 OWNER_ID = 0
 ADMIN_GROUP_ID = 0
 DB_PATH = "bot_pedidos.db"
+
+# Anti-flood por usuario: acción -> (ráfaga máxima, mensajes por segundo recuperados)
+RATE_LIMITS = {
+    "pedido": (3, 1 / 60),
+    "soporte": (5, 1 / 10),
+    "comando": (10, 1 / 2),
+}
+MAX_OPEN_PEDIDOS = 5
+
+# Varios bots en un proceso: una entrada por comunidad, cada una con su base de datos.
+# Claves: name, token, owner_id, admin_group_id, canal_username, grupo_username, db_path.
+# Vacío = un solo bot con las constantes de arriba.
+BOTS = []
+
+# Logs: JSON (una línea por evento) escritos desde un hilo aparte.
+# Muestreo por logger: nombre -> (fracción que se conserva, máximo por segundo)
+LOG_JSON = True
+LOG_SAMPLING = {
+    "pedidos.hot": (0.1, 20),
+}
+
+# Segundos entre resúmenes de errores enviados al dueño
+ERROR_DIGEST_INTERVAL = 300
+
+# Reintentos de la Bot API: presupuesto por ventana y circuit breaker
+RETRY_POLICY = {
+    "budget": 60,             # reintentos permitidos por ventana
+    "window": 60,             # segundos
+    "failure_threshold": 5,   # fallos transitorios seguidos que abren el circuito
+    "cooldown": 30,           # segundos con el circuito abierto
+    "max_retry_after": 30,    # RetryAfter más largo que se espera dentro de un handler
+}
+
+# Reparto automático de pedidos nuevos entre los admins que usan /disponible
+AUTO_ASSIGN = True
+MAX_PEDIDOS_POR_ADMIN = 10
+
+# SLA: segundos que un pedido puede seguir en cada estado antes de avisar en el grupo de admins
+SLA_LIMITS = {
+    "pending": 3600,
+    "in_progress": 24 * 3600,
+}
+
+# Mantenimiento programado (JobQueue): ventana de poco tráfico en hora local y
+# horas entre ejecuciones de cada tarea (limpieza, soporte, optimize, vacuum, backup)
+MAINTENANCE = {
+    "ventana": ("03:00", "05:00"),
+    "tareas": {"limpieza": 24, "soporte": 24, "optimize": 24, "vacuum": 24, "backup": 24},
+    "retencion_dias": 30,
+    "eventos_dias": 90,
+    "agregados_dias": 365,  # rollups e histograma de latencias por hora
+    "soporte_dias": 7,      # sesiones cerradas que siguen en la tabla caliente
+    "soporte_meses": 12,    # meses de tablas soporte_archivo_AAAAMM que se conservan
+    "hilos_dias": 90,       # respuestas enrutables en el grupo de admins
+    "vacuum_paginas": 2000,
+    "backups_dir": "backups",
+    "backups_keep": 7,
+}
+
+# Trazas por update (spans de handlers, base de datos y Bot API) en JSONL con forma OpenTelemetry.
+# Se guardan las trazas con error, las más lentas que slow_ms y una fracción sample_rate del resto.
+TRACING = {
+    "enabled": True,
+    "path": "traces/traces.jsonl",
+    "max_bytes": 10 * 1024 * 1024,
+    "backups": 5,
+    "sample_rate": 0.01,
+    "slow_ms": 1000,
+}
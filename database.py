@@ -1,14 +1,81 @@
 # database.py
 import aiosqlite
+import asyncio
+import collections
+import contextvars
+import sys
 import os
 import csv
-from datetime import datetime, timedelta
+import re
+import time
+import unicodedata
+from bisect import bisect_left
+from datetime import datetime
+
+from tracing import trace_module
 
 DB_PATH = "bot_pedidos.db"
 
+# Ruta de la base del bot que atiende la tarea actual (varios bots por proceso)
+_db_path_var = contextvars.ContextVar("db_path", default=None)
+
+
+def db_path() -> str:
+    return _db_path_var.get() or DB_PATH
+
+
+def use_db(path: str):
+    """Fija la base de datos para el contexto actual y las tareas que cree."""
+    return _db_path_var.set(path)
+
+
+# Cachés en memoria por base (este proceso es el único que escribe config y
+# roles). Vacías hasta warm_caches(); mientras tanto se lee de SQLite.
+_config_cache = {}  # db_path -> {key: value}
+_roles_cache = {}  # db_path -> {user_id: rol} (solo roles distintos de 'user')
+
+
+async def warm_caches() -> dict:
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT key, value FROM config") as cur:
+            config = dict(await cur.fetchall())
+        async with db.execute("SELECT user_id, rol FROM usuarios WHERE rol IS NOT NULL AND rol != 'user'") as cur:
+            roles = dict(await cur.fetchall())
+    _config_cache[db_path()] = config
+    _roles_cache[db_path()] = roles
+    return {"config": len(config), "roles": len(roles)}
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Columnas TEXT heredadas -> columnas INTEGER (epoch UTC) que las reemplazan
+_TS_MIGRATIONS = (
+    ("pedidos", "fecha", "fecha_ts"),
+    ("pedidos", "assigned_at", "assigned_ts"),
+    ("pedidos", "ready_at", "ready_ts"),
+    ("usuarios", "fecha_registro", "registro_ts"),
+    ("soporte", "fecha", "fecha_ts"),
+)
+
+
+def now_ts() -> int:
+    return int(time.time())
+
+
+def fmt_ts(ts, fmt: str = TS_FORMAT) -> str:
+    """Formatea un epoch UTC en hora local; solo para mostrar."""
+    if not ts:
+        return "-"
+    return datetime.fromtimestamp(ts).strftime(fmt)
+
+
+async def _table_columns(db, table: str) -> list:
+    async with db.execute(f"PRAGMA table_info({table})") as cur:
+        return [c[1] for c in await cur.fetchall()]
+
+
 async def init_db():
-    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    async with aiosqlite.connect(DB_PATH) as db:
+    os.makedirs(os.path.dirname(db_path()) or ".", exist_ok=True)
+    async with aiosqlite.connect(db_path()) as db:
         # usuarios: idioma, rol (owner/admin/user), nombre
         await db.execute("""
             CREATE TABLE IF NOT EXISTS usuarios (
@@ -16,7 +83,7 @@ async def init_db():
                 nombre TEXT,
                 idioma TEXT DEFAULT 'es',
                 rol TEXT DEFAULT 'user',
-                fecha_registro TEXT
+                registro_ts INTEGER
             )
         """)
         # pedidos
@@ -26,36 +93,9 @@ async def init_db():
                 user_id INTEGER,
                 tipo TEXT,
                 descripcion TEXT,
-                fecha TEXT
+                fecha_ts INTEGER
             )
         """)
-        async with db.execute("PRAGMA table_info(pedidos)") as cur:
-            cols = await cur.fetchall()
-            col_names = [c[1] for c in cols]
-        # Add estado
-        if 'estado' not in col_names:
-            try:
-                await db.execute("ALTER TABLE pedidos ADD COLUMN estado TEXT DEFAULT 'pending'")
-            except Exception:
-                pass
-
-        if 'assigned_admin_id' not in col_names:
-            try:
-                await db.execute("ALTER TABLE pedidos ADD COLUMN assigned_admin_id INTEGER DEFAULT NULL")
-            except Exception:
-                pass
-
-        if 'assigned_at' not in col_names:
-            try:
-                await db.execute("ALTER TABLE pedidos ADD COLUMN assigned_at TEXT DEFAULT NULL")
-            except Exception:
-                pass
-        if 'ready_at' not in col_names:
-            try:
-                await db.execute("ALTER TABLE pedidos ADD COLUMN ready_at TEXT DEFAULT NULL")
-            except Exception:
-                pass
-
         await db.execute("""
             CREATE TABLE IF NOT EXISTS soporte (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -63,9 +103,120 @@ async def init_db():
                 admin_msg_id INTEGER,
                 user_msg_id INTEGER,
                 estado TEXT DEFAULT 'open',
-                fecha TEXT
+                fecha_ts INTEGER
+            )
+        """)
+
+        # columnas añadidas después de la primera versión del esquema
+        new_columns = (
+            ("pedidos", "estado", "TEXT DEFAULT 'pending'"),
+            ("pedidos", "assigned_admin_id", "INTEGER DEFAULT NULL"),
+            ("pedidos", "fecha_ts", "INTEGER DEFAULT NULL"),
+            ("pedidos", "assigned_ts", "INTEGER DEFAULT NULL"),
+            ("pedidos", "ready_ts", "INTEGER DEFAULT NULL"),
+            ("usuarios", "registro_ts", "INTEGER DEFAULT NULL"),
+            ("soporte", "fecha_ts", "INTEGER DEFAULT NULL"),
+            ("pedidos", "canonical_ticket", "TEXT DEFAULT NULL"),
+            ("pedidos", "trigramas", "INTEGER DEFAULT NULL"),
+            ("usuarios", "username", "TEXT DEFAULT NULL"),
+            ("usuarios", "nombre_completo", "TEXT DEFAULT NULL"),
+            ("usuarios", "last_seen", "INTEGER DEFAULT NULL"),
+            ("usuarios", "activo", "INTEGER DEFAULT 1"),
+            ("soporte", "ultimo_ts", "INTEGER DEFAULT NULL"),
+            ("soporte", "cerrado_ts", "INTEGER DEFAULT NULL"),
+            ("soporte", "mensajes", "INTEGER DEFAULT 1"),
+        )
+        columns = {}
+        for table, col, ddl in new_columns:
+            if table not in columns:
+                columns[table] = await _table_columns(db, table)
+            if col not in columns[table]:
+                try:
+                    await db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}")
+                except Exception:
+                    pass
+
+        # índices para la paginación por (fecha_ts, ticket), con y sin filtros
+        await db.execute("DROP INDEX IF EXISTS idx_pedidos_fecha_ts")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_fecha_ticket ON pedidos(fecha_ts, ticket)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_estado_fecha ON pedidos(estado, fecha_ts, ticket)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_tipo_fecha ON pedidos(tipo, fecha_ts, ticket)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_admin_fecha ON pedidos(assigned_admin_id, fecha_ts, ticket)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_user_estado ON pedidos(user_id, estado)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_registro_ts ON usuarios(registro_ts)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_activo ON usuarios(activo, user_id)")
+        # soporte solo guarda sesiones abiertas o cerradas hace poco (ver soporte_compactar)
+        await db.execute("DROP INDEX IF EXISTS idx_soporte_user_estado")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_soporte_abiertas ON soporte(user_id, fecha_ts) WHERE estado='open'")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_soporte_cerradas ON soporte(cerrado_ts) WHERE estado='closed'")
+
+        # índice de trigramas de los pedidos canónicos abiertos (detección de duplicados)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS pedido_trigramas (
+                trigrama TEXT,
+                ticket TEXT,
+                PRIMARY KEY (trigrama, ticket)
+            ) WITHOUT ROWID
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedido_trigramas_ticket ON pedido_trigramas(ticket)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_canonical ON pedidos(canonical_ticket)")
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_trigramas_pedido_del AFTER DELETE ON pedidos BEGIN
+                DELETE FROM pedido_trigramas WHERE ticket=OLD.ticket;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_trigramas_pedido_cerrado AFTER UPDATE OF estado ON pedidos
+            WHEN NEW.estado IN ('ready', 'cancelled') BEGIN
+                DELETE FROM pedido_trigramas WHERE ticket=NEW.ticket;
+            END
+        """)
+
+        # historial de transiciones (solo se añaden filas) y agregados incrementales
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS pedido_eventos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket TEXT,
+                user_id INTEGER,
+                tipo TEXT,
+                evento TEXT,
+                admin_id INTEGER,
+                ts INTEGER,
+                duracion INTEGER
             )
         """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pedido_eventos_ts ON pedido_eventos(ts)")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS pedido_rollups (
+                hora INTEGER,
+                tipo TEXT,
+                admin_id INTEGER,
+                evento TEXT,
+                n INTEGER DEFAULT 0,
+                total_secs INTEGER DEFAULT 0,
+                PRIMARY KEY (hora, tipo, admin_id, evento)
+            ) WITHOUT ROWID
+        """)
+        # histograma de latencias por hora, para ventanearlo igual que los rollups
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS pedido_latencias_hora (
+                metrica TEXT,
+                hora INTEGER,
+                bucket INTEGER,
+                n INTEGER DEFAULT 0,
+                PRIMARY KEY (metrica, hora, bucket)
+            ) WITHOUT ROWID
+        """)
+
+        # contadores materializados, mantenidos por triggers
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS estadisticas (
+                clave TEXT PRIMARY KEY,
+                valor INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        for trigger in _STATS_TRIGGERS:
+            await db.execute(trigger)
 
         await db.execute("""
             CREATE TABLE IF NOT EXISTS config (
@@ -73,89 +224,385 @@ async def init_db():
                 value TEXT
             )
         """)
+        # historial de tareas de mantenimiento (duración y resultado)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS mantenimiento_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tarea TEXT,
+                inicio_ts INTEGER,
+                duracion_ms INTEGER,
+                ok INTEGER,
+                detalle TEXT
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_mantenimiento_tarea ON mantenimiento_log(tarea, ok, inicio_ts)")
+        # mensajes del bot en el grupo de admins -> usuario al que va la respuesta
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS hilos (
+                chat_id INTEGER,
+                admin_msg_id INTEGER,
+                user_id INTEGER NOT NULL,
+                tipo TEXT,
+                ticket TEXT,
+                fecha_ts INTEGER,
+                PRIMARY KEY (chat_id, admin_msg_id)
+            ) WITHOUT ROWID
+        """)
+        # admins que reciben pedidos automáticamente (tipos separados por comas)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS admin_disponibilidad (
+                admin_id INTEGER PRIMARY KEY,
+                tipos TEXT DEFAULT '',
+                desde_ts INTEGER
+            )
+        """)
         await db.commit()
+        async with db.execute("SELECT 1 FROM estadisticas WHERE clave='usuarios'") as cur:
+            stats_ready = await cur.fetchone()
+    if not stats_ready:
+        await reconcile_stats()
+
+
+async def migrate_text_timestamps(batch_size: int = 500, pause: float = 0.05) -> int:
+    """Rellena las columnas *_ts a partir de las fechas TEXT heredadas.
+
+    Se ejecuta en lotes pequeños, cada uno en su propia transacción, para no
+    bloquear la base de datos mientras el bot sigue atendiendo. Las fechas
+    antiguas se guardaron con la hora local del servidor; el modificador
+    'utc' de SQLite las convierte a UTC. Las que no se pueden interpretar
+    quedan a 0.
+    """
+    if await config_get("ts_migration") == "done":
+        return 0
+    total = 0
+    for table, old, new in _TS_MIGRATIONS:
+        async with aiosqlite.connect(db_path()) as db:
+            if old not in await _table_columns(db, table):
+                continue
+            while True:
+                cur = await db.execute(f"""
+                    UPDATE {table}
+                    SET {new}=COALESCE(CAST(strftime('%s', {old}, 'utc') AS INTEGER), 0)
+                    WHERE rowid IN (
+                        SELECT rowid FROM {table}
+                        WHERE {new} IS NULL AND {old} IS NOT NULL AND {old} != ''
+                        LIMIT ?
+                    )
+                """, (batch_size,))
+                await db.commit()
+                total += cur.rowcount
+                if cur.rowcount < batch_size:
+                    break
+                await asyncio.sleep(pause)
+    await config_set("ts_migration", "done")
+    return total
+
+async def backfill_trigramas(batch_size: int = 500) -> int:
+    """Indexa los pedidos canónicos abiertos creados antes de la deduplicación.
+
+    Esos pedidos tienen trigramas NULL y no estaban en pedido_trigramas, así
+    que los nuevos no podían enlazarse con ellos. Se ejecuta una sola vez.
+    """
+    if await config_get("trigramas_migration") == "done":
+        return 0
+    total = 0
+    async with aiosqlite.connect(db_path()) as db:
+        while True:
+            async with db.execute("""
+                SELECT ticket, descripcion FROM pedidos
+                WHERE trigramas IS NULL AND canonical_ticket IS NULL AND estado IN ('pending', 'in_progress')
+                LIMIT ?
+            """, (batch_size,)) as cur:
+                rows = await cur.fetchall()
+            for ticket, descripcion in rows:
+                grams = trigramas(normalize_descripcion(descripcion))
+                if len(grams) > DUP_MAX_TRIGRAMAS:
+                    grams = set()
+                await db.execute("UPDATE pedidos SET trigramas=? WHERE ticket=?", (len(grams), ticket))
+                await db.executemany(
+                    "INSERT OR IGNORE INTO pedido_trigramas (trigrama, ticket) VALUES (?, ?)",
+                    [(g, ticket) for g in grams]
+                )
+            await db.commit()
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    await config_set("trigramas_migration", "done")
+    return total
 
 # ---------------- Users ----------------
-async def add_user(user_id: int, nombre: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def add_user(user_id: int, nombre: str, username: str = None, nombre_completo: str = None):
+    now = now_ts()
+    async with aiosqlite.connect(db_path()) as db:
         await db.execute(
-            "INSERT OR IGNORE INTO usuarios (user_id, nombre, fecha_registro) VALUES (?, ?, ?)",
-            (user_id, nombre, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            "INSERT OR IGNORE INTO usuarios (user_id, nombre, username, nombre_completo, registro_ts, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, nombre, username, nombre_completo, now, now)
         )
         await db.commit()
 
+async def update_user_profiles(perfiles: list):
+    """Actualiza en una transacción [(user_id, username, nombre_completo, last_seen)].
+
+    Solo toca usuarios ya registrados; el alta sigue siendo add_user (/start).
+    """
+    if not perfiles:
+        return
+    async with aiosqlite.connect(db_path()) as db:
+        await db.executemany(
+            # si escribe, no tiene el bot bloqueado: vuelve a recibir difusiones
+            "UPDATE usuarios SET username=?, nombre_completo=?, last_seen=?, activo=1 WHERE user_id=?",
+            [(username, nombre_completo, last_seen, user_id) for user_id, username, nombre_completo, last_seen in perfiles]
+        )
+        await db.commit()
+
+async def get_user_profile(user_id: int):
+    """(username, nombre) guardados del usuario, o (None, None)."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT username, COALESCE(NULLIF(nombre_completo, ''), nombre) FROM usuarios WHERE user_id=?", (user_id,)) as cur:
+            r = await cur.fetchone()
+            return (r[0], r[1]) if r else (None, None)
+
 async def set_lang(user_id: int, idioma: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         await db.execute("UPDATE usuarios SET idioma=? WHERE user_id=?", (idioma, user_id))
         await db.commit()
 
 async def get_lang(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         async with db.execute("SELECT idioma FROM usuarios WHERE user_id=?", (user_id,)) as cur:
             r = await cur.fetchone()
             return r[0] if r else "es"
 
 async def set_role(user_id: int, role: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         await db.execute("""
-            INSERT INTO usuarios (user_id, nombre, idioma, rol, fecha_registro)
-            VALUES (?, COALESCE((SELECT nombre FROM usuarios WHERE user_id=?), ''), COALESCE((SELECT idioma FROM usuarios WHERE user_id=?), 'es'), ?, COALESCE((SELECT fecha_registro FROM usuarios WHERE user_id=?), ?))
+            INSERT INTO usuarios (user_id, nombre, idioma, rol, registro_ts)
+            VALUES (?, '', 'es', ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET rol=excluded.rol
-        """, (user_id, user_id, user_id, role, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        """, (user_id, role, now_ts()))
         await db.commit()
+    roles = _roles_cache.get(db_path())
+    if roles is not None:
+        if role == "user":
+            roles.pop(user_id, None)
+        else:
+            roles[user_id] = role
 
 async def get_role(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
+    roles = _roles_cache.get(db_path())
+    if roles is not None:
+        return roles.get(user_id, "user")
+    async with aiosqlite.connect(db_path()) as db:
         async with db.execute("SELECT rol FROM usuarios WHERE user_id=?", (user_id,)) as cur:
             r = await cur.fetchone()
             return r[0] if r else "user"
 
-async def get_all_users() -> list:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id FROM usuarios") as cur:
-            rows = await cur.fetchall()
-            return [r[0] for r in rows]
+def _audiencia_where(idioma: str = None, rol: str = None, desde: int = None, hasta: int = None,
+                     activos_desde: int = None):
+    where, params = ["activo=1"], []
+    if idioma:
+        where.append("idioma=?")
+        params.append(idioma)
+    if rol:
+        where.append("rol=?")
+        params.append(rol)
+    if desde:
+        where.append("registro_ts >= ?")
+        params.append(desde)
+    if hasta:
+        where.append("registro_ts < ?")
+        params.append(hasta)
+    if activos_desde:
+        where.append("last_seen >= ?")
+        params.append(activos_desde)
+    return " AND ".join(where), params
 
-async def count_users() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM usuarios") as cur:
-            r = await cur.fetchone()
-            return r[0] if r else 0
 
-async def count_admins() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*) FROM usuarios WHERE rol='admin'") as cur:
+async def iter_audiencia(batch_size: int = 500, **segmento):
+    """Recorre los user_id activos del segmento en lotes por clave (user_id).
+
+    La conexión se cierra entre lotes, así una difusión larga no mantiene
+    abierta una lectura ni carga toda la tabla en memoria.
+    """
+    where, params = _audiencia_where(**segmento)
+    last = None
+    while True:
+        cond = where + (" AND user_id > ?" if last is not None else "")
+        args = params + ([last] if last is not None else [])
+        async with aiosqlite.connect(db_path()) as db:
+            async with db.execute(
+                f"SELECT user_id FROM usuarios WHERE {cond} ORDER BY user_id LIMIT ?", (*args, batch_size)
+            ) as cur:
+                rows = await cur.fetchall()
+        for (uid,) in rows:
+            yield uid
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0]
+
+
+async def count_audiencia(**segmento) -> int:
+    where, params = _audiencia_where(**segmento)
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(f"SELECT COUNT(*) FROM usuarios WHERE {where}", params) as cur:
             r = await cur.fetchone()
             return r[0] if r else 0
 
+
+async def mark_users_inactive(user_ids: list):
+    """Usuarios que bloquearon el bot o ya no existen: se excluyen de las difusiones."""
+    if not user_ids:
+        return
+    async with aiosqlite.connect(db_path()) as db:
+        await db.executemany("UPDATE usuarios SET activo=0 WHERE user_id=?", [(u,) for u in user_ids])
+        await db.commit()
+
+
 # ---------------- Pedidos ----------------
 def _ticket_now() -> str:
     return "TCK" + datetime.now().strftime("%Y%m%d%H%M%S%f")[-14:]
 
-async def add_pedido(user_id: int, tipo: str, descripcion: str) -> str:
+# Similitud de Jaccard mínima entre trigramas para considerar dos pedidos iguales
+DUP_THRESHOLD = 0.6
+# Por encima de este número de trigramas la descripción no es un título; no se deduplica
+DUP_MAX_TRIGRAMAS = 300
+
+
+def normalize_descripcion(text: str) -> str:
+    """Minúsculas, sin acentos ni signos de puntuación y con espacios simples."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", text).split())
+
+
+def trigramas(norm: str) -> set:
+    """Trigramas por palabra, con relleno como en pg_trgm ("  ab", " ab", "ab ")."""
+    result = set()
+    for word in norm.split():
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+async def _find_canonical(db, tipo: str, grams: set):
+    placeholders = ", ".join("?" for _ in grams)
+    async with db.execute(f"""
+        SELECT p.ticket, p.trigramas, COUNT(*) AS comunes
+        FROM pedido_trigramas t JOIN pedidos p ON p.ticket = t.ticket
+        WHERE t.trigrama IN ({placeholders}) AND p.tipo = ?
+          AND p.canonical_ticket IS NULL AND p.estado IN ('pending', 'in_progress')
+        GROUP BY p.ticket
+        ORDER BY comunes DESC
+        LIMIT 20
+    """, (*grams, tipo)) as cur:
+        candidatos = await cur.fetchall()
+    best, best_sim = None, DUP_THRESHOLD
+    for ticket, n, comunes in candidatos:
+        sim = comunes / float(len(grams) + (n or 0) - comunes)
+        if sim >= best_sim:
+            best, best_sim = ticket, sim
+    return best
+
+
+async def add_pedido_dedup(user_id: int, tipo: str, descripcion: str, max_abiertos: int = None):
+    """Registra el pedido y lo enlaza a un pedido abierto equivalente si lo hay.
+
+    Devuelve (ticket, canonical_ticket); canonical_ticket es None cuando el
+    pedido es nuevo y queda él mismo como canónico. Si el usuario ya tiene
+    `max_abiertos` pedidos abiertos no se registra nada y devuelve (None, None).
+    """
     ticket = _ticket_now()
-    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
+    now = now_ts()
+    grams = trigramas(normalize_descripcion(descripcion))
+    if len(grams) > DUP_MAX_TRIGRAMAS:
+        grams = set()
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        if max_abiertos:
+            async with db.execute(
+                "SELECT COUNT(*) FROM pedidos WHERE user_id=? AND estado IN ('pending', 'in_progress')", (user_id,)
+            ) as cur:
+                (abiertos,) = await cur.fetchone()
+            if abiertos >= max_abiertos:
+                await db.rollback()
+                return None, None
+        canonical = await _find_canonical(db, tipo, grams) if grams else None
         await db.execute(
-            "INSERT INTO pedidos (ticket, user_id, tipo, descripcion, fecha, estado) VALUES (?, ?, ?, ?, ?, 'pending')",
-            (ticket, user_id, tipo, descripcion, fecha)
+            "INSERT INTO pedidos (ticket, user_id, tipo, descripcion, fecha_ts, estado, canonical_ticket, trigramas) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (ticket, user_id, tipo, descripcion, now, canonical, len(grams))
         )
+        if grams and not canonical:
+            await db.executemany(
+                "INSERT OR IGNORE INTO pedido_trigramas (trigrama, ticket) VALUES (?, ?)",
+                [(g, ticket) for g in grams]
+            )
+        await _record_evento(db, {"ticket": ticket, "user_id": user_id, "tipo": tipo}, "created", None, now)
         await db.commit()
+    return ticket, canonical
+
+
+async def add_pedido(user_id: int, tipo: str, descripcion: str) -> str:
+    ticket, _ = await add_pedido_dedup(user_id, tipo, descripcion)
     return ticket
 
 async def get_pedidos(limit: int = 100) -> list:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT ticket, user_id, tipo, descripcion, fecha FROM pedidos ORDER BY fecha DESC LIMIT ?", (limit,)) as cur:
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT ticket, user_id, tipo, descripcion, fecha_ts FROM pedidos ORDER BY fecha_ts DESC LIMIT ?", (limit,)) as cur:
             return await cur.fetchall()
 
+async def get_pedidos_page(limit: int = 10, cursor: tuple = None, older: bool = True,
+                           estado: str = None, tipo: str = None, admin_id: int = None):
+    """Página de pedidos por keyset sobre (fecha_ts, ticket), del más reciente al más antiguo.
+
+    `cursor` es el (fecha_ts, ticket) del borde de la página actual; con
+    older=True se devuelven los pedidos anteriores a él y con older=False los
+    posteriores. Devuelve (filas, hay_mas) donde hay_mas indica si quedan
+    pedidos más allá de la página en la dirección pedida.
+    """
+    where, params = [], []
+    if estado:
+        where.append("estado=?")
+        params.append(estado)
+    if tipo:
+        where.append("tipo=?")
+        params.append(tipo)
+    if admin_id:
+        where.append("assigned_admin_id=?")
+        params.append(admin_id)
+    if cursor:
+        # fecha_ts puede ser NULL mientras migrate_text_timestamps rellena las
+        # filas heredadas; NULL ordena antes que cualquier fecha (el más antiguo)
+        ts, ticket = cursor
+        if ts is None:
+            where.append("(fecha_ts IS NULL AND ticket < ?)" if older
+                         else "(fecha_ts IS NOT NULL OR ticket > ?)")
+            params.append(ticket)
+        else:
+            where.append("((fecha_ts, ticket) < (?, ?) OR fecha_ts IS NULL)" if older
+                         else "(fecha_ts, ticket) > (?, ?)")
+            params.extend(cursor)
+    order = "DESC" if older else "ASC"
+    sql = "SELECT ticket, user_id, tipo, descripcion, fecha_ts, estado, assigned_admin_id FROM pedidos"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY fecha_ts {order}, ticket {order} LIMIT ?"
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(sql, (*params, limit + 1)) as cur:
+            rows = await cur.fetchall()
+    hay_mas = len(rows) > limit
+    rows = rows[:limit]
+    if not older:
+        rows.reverse()
+    return rows, hay_mas
+
 async def get_pedido(ticket: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT ticket, user_id, tipo, descripcion, fecha FROM pedidos WHERE ticket=?", (ticket,)) as cur:
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT ticket, user_id, tipo, descripcion, fecha_ts FROM pedidos WHERE ticket=?", (ticket,)) as cur:
             return await cur.fetchone()
 
 
 async def get_pedido_full(ticket: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         async with db.execute("PRAGMA table_info(pedidos)") as cur:
             cols = await cur.fetchall()
             col_names = [c[1] for c in cols]
@@ -169,86 +616,494 @@ async def get_pedido_full(ticket: str):
 
 async def search_pedidos(term: str, limit: int = 100):
     like = f"%{term}%"
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         async with db.execute(
-            "SELECT ticket, user_id, tipo, descripcion, fecha FROM pedidos WHERE descripcion LIKE ? OR tipo LIKE ? ORDER BY fecha DESC LIMIT ?",
+            "SELECT ticket, user_id, tipo, descripcion, fecha_ts FROM pedidos WHERE descripcion LIKE ? OR tipo LIKE ? ORDER BY fecha_ts DESC LIMIT ?",
             (like, like, limit)
         ) as cur:
             return await cur.fetchall()
 
 async def delete_pedido(ticket: str) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM pedidos WHERE ticket=?", (ticket,))
+    """Elimina el pedido junto con los duplicados enlazados a él."""
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute("DELETE FROM pedidos WHERE ticket=? OR canonical_ticket=?", (ticket, ticket))
         await db.commit()
     return True
 
 
+async def get_seguidores(ticket: str) -> list:
+    """Pedidos abiertos enlazados como duplicados de `ticket`: [(ticket, user_id)]."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            "SELECT ticket, user_id FROM pedidos WHERE canonical_ticket=? AND estado IN ('pending', 'in_progress')",
+            (ticket,)
+        ) as cur:
+            return await cur.fetchall()
+
+
+# Estados de origen permitidos para llegar a cada estado
+PEDIDO_TRANSICIONES = {
+    'in_progress': ('pending',),
+    'ready': ('pending', 'in_progress'),
+    'cancelled': ('pending', 'in_progress'),
+}
+
+_PEDIDO_RETURNING = "ticket, user_id, tipo, descripcion, estado, assigned_admin_id, fecha_ts, assigned_ts, ready_ts"
+_PEDIDO_RETURNING_COLS = [c.strip() for c in _PEDIDO_RETURNING.split(",")]
+
+
+async def transition_pedido(ticket: str, estado: str, admin_id: int = None):
+    """Aplica una transición de estado con una sola UPDATE condicional.
+
+    Devuelve el pedido actualizado como dict si la transición se aplicó, o
+    None si el pedido no existe o ya no estaba en un estado de origen
+    permitido (por ejemplo, otro admin lo tomó antes). Los duplicados
+    enlazados siguen al pedido canónico en la misma transacción y se
+    devuelven en la clave 'seguidores'.
+    """
+    origenes = PEDIDO_TRANSICIONES.get(estado)
+    if not origenes:
+        raise ValueError(f"Estado de destino no válido: {estado}")
+    now = now_ts()
+    if estado == 'in_progress':
+        sets, params = "estado=?, assigned_admin_id=?, assigned_ts=?", [estado, admin_id, now]
+    elif estado == 'ready':
+        sets, params = "estado=?, assigned_admin_id=COALESCE(assigned_admin_id, ?), ready_ts=?", [estado, admin_id, now]
+    else:
+        sets, params = "estado=?, assigned_admin_id=COALESCE(assigned_admin_id, ?)", [estado, admin_id]
+    placeholders = ", ".join("?" for _ in origenes)
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            f"UPDATE pedidos SET {sets} WHERE ticket=? AND COALESCE(estado, 'pending') IN ({placeholders}) RETURNING {_PEDIDO_RETURNING}",
+            (*params, ticket, *origenes)
+        ) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return None
+        pedido = dict(zip(_PEDIDO_RETURNING_COLS, row))
+        async with db.execute(
+            f"UPDATE pedidos SET {sets} WHERE canonical_ticket=? AND COALESCE(estado, 'pending') IN ({placeholders}) RETURNING {_PEDIDO_RETURNING}",
+            (*params, ticket, *origenes)
+        ) as cur:
+            pedido['seguidores'] = [dict(zip(_PEDIDO_RETURNING_COLS, r)) for r in await cur.fetchall()]
+        for p in [pedido] + pedido['seguidores']:
+            duracion = None
+            if estado in _LAT_METRICAS and p.get('fecha_ts'):
+                duracion = max(0, now - p['fecha_ts'])
+            await _record_evento(db, p, estado, admin_id, now, duracion)
+        await db.commit()
+    return pedido
+
+
+async def get_pedidos_abiertos() -> list:
+    """Pedidos canónicos pendientes o en curso (para cargar plazos al arrancar)."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            f"SELECT {_PEDIDO_RETURNING} FROM pedidos "
+            "WHERE estado IN ('pending', 'in_progress') AND canonical_ticket IS NULL"
+        ) as cur:
+            return [dict(zip(_PEDIDO_RETURNING_COLS, r)) for r in await cur.fetchall()]
+
+
 async def set_pedido_estado(ticket: str, estado: str):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE pedidos SET estado=? WHERE ticket=?", (estado, ticket))
-        if estado == 'in_progress':
-            try:
-                await db.execute("UPDATE pedidos SET assigned_at=? WHERE ticket=?", (now, ticket))
-            except Exception:
-                pass
-        if estado == 'ready':
-            try:
-                await db.execute("UPDATE pedidos SET ready_at=? WHERE ticket=?", (now, ticket))
-            except Exception:
-                pass
+    """Fija el estado sin comprobar el estado de origen (uso administrativo)."""
+    now = now_ts()
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute("""
+            UPDATE pedidos SET estado=?,
+                assigned_ts=CASE WHEN ?='in_progress' THEN ? ELSE assigned_ts END,
+                ready_ts=CASE WHEN ?='ready' THEN ? ELSE ready_ts END
+            WHERE ticket=?
+        """, (estado, estado, now, estado, now, ticket))
         await db.commit()
 
 
 async def assign_pedido(ticket: str, admin_id: int):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE pedidos SET assigned_admin_id=? WHERE ticket=?", (admin_id, ticket))
-        try:
-            await db.execute("UPDATE pedidos SET assigned_at=? WHERE ticket=?", (now, ticket))
-        except Exception:
-            pass
+    """Asigna un pedido pendiente a un admin; None si ya estaba asignado o cerrado."""
+    return await transition_pedido(ticket, 'in_progress', admin_id)
+
+
+# ---------- reparto automático ----------
+async def set_admin_disponible(admin_id: int, tipos: list = None):
+    """Da de alta al admin en el reparto automático; `tipos` vacío = todos."""
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute(
+            "INSERT INTO admin_disponibilidad (admin_id, tipos, desde_ts) VALUES (?, ?, ?) "
+            "ON CONFLICT(admin_id) DO UPDATE SET tipos=excluded.tipos, desde_ts=excluded.desde_ts",
+            (admin_id, ",".join(tipos or []), now_ts())
+        )
         await db.commit()
 
 
-async def count_pedidos_by_estado() -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT estado, COUNT(*) FROM pedidos GROUP BY estado") as cur:
-            rows = await cur.fetchall()
-            return {r[0] or 'unknown': r[1] for r in rows}
+async def unset_admin_disponible(admin_id: int) -> bool:
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("DELETE FROM admin_disponibilidad WHERE admin_id=?", (admin_id,))
+        await db.commit()
+    return cur.rowcount > 0
 
-# ---------------- Soporte (chat admin) ----------------
-async def soporte_create_entry(user_id: int, user_msg_id: int, admin_msg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO soporte (user_id, admin_msg_id, user_msg_id, estado, fecha) VALUES (?, ?, ?, 'open', ?)",
-            (user_id, admin_msg_id, user_msg_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+async def get_admins_disponibles() -> dict:
+    """{admin_id: set de tipos}; un set vacío significa que acepta cualquier tipo."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT admin_id, tipos FROM admin_disponibilidad") as cur:
+            return {a: set(filter(None, (t or "").split(","))) for a, t in await cur.fetchall()}
+
+
+async def get_admin_loads() -> dict:
+    """Pedidos en curso por admin."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            "SELECT assigned_admin_id, COUNT(*) FROM pedidos "
+            "WHERE estado='in_progress' AND assigned_admin_id IS NOT NULL GROUP BY assigned_admin_id"
+        ) as cur:
+            return dict(await cur.fetchall())
+
+
+# ---------------- Eventos y analítica de pedidos ----------------
+# Límites superiores (segundos) de los buckets del histograma de latencias
+_LAT_BUCKETS = (10, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 28800, 43200, 86400, 172800, 345600, 604800)
+# evento -> métrica de latencia desde la creación del pedido
+_LAT_METRICAS = {'in_progress': 'take', 'ready': 'ready'}
+
+
+async def _record_evento(db, pedido: dict, evento: str, admin_id, ts: int, duracion: int = None):
+    """Escribe el evento y actualiza los agregados dentro de la transacción de `db`."""
+    tipo = pedido.get('tipo') or ''
+    await db.execute(
+        "INSERT INTO pedido_eventos (ticket, user_id, tipo, evento, admin_id, ts, duracion) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (pedido.get('ticket'), pedido.get('user_id'), tipo, evento, admin_id, ts, duracion)
+    )
+    await db.execute("""
+        INSERT INTO pedido_rollups (hora, tipo, admin_id, evento, n, total_secs) VALUES (?, ?, ?, ?, 1, ?)
+        ON CONFLICT(hora, tipo, admin_id, evento) DO UPDATE SET n=n+1, total_secs=total_secs+excluded.total_secs
+    """, (ts - ts % 3600, tipo, admin_id or 0, evento, duracion or 0))
+    if duracion is not None and evento in _LAT_METRICAS:
+        await db.execute("""
+            INSERT INTO pedido_latencias_hora (metrica, hora, bucket, n) VALUES (?, ?, ?, 1)
+            ON CONFLICT(metrica, hora, bucket) DO UPDATE SET n=n+1
+        """, (_LAT_METRICAS[evento], ts - ts % 3600, bisect_left(_LAT_BUCKETS, duracion)))
+
+
+def _percentil(hist: dict, q: float):
+    """Estimación del percentil q a partir del histograma {bucket: n}.
+
+    Devuelve (límite, desbordado): el límite superior del bucket, o el último
+    límite con desbordado=True si cae por encima de todos (se lee "≥ límite").
+    None si el histograma está vacío.
+    """
+    total = sum(hist.values())
+    if not total:
+        return None
+    acumulado = 0
+    for bucket in sorted(hist):
+        acumulado += hist[bucket]
+        if acumulado >= q * total:
+            break
+    if bucket >= len(_LAT_BUCKETS):
+        return _LAT_BUCKETS[-1], True
+    return _LAT_BUCKETS[bucket], False
+
+
+async def get_pedido_analytics(hours: int = 24) -> dict:
+    """Rendimiento y latencias de las últimas `hours` horas, leídos solo de los agregados."""
+    desde = now_ts() - hours * 3600
+    desde -= desde % 3600
+    eventos, por_tipo, por_admin = {}, {}, {}
+    hist = {m: {} for m in _LAT_METRICAS.values()}
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            "SELECT evento, tipo, admin_id, SUM(n) FROM pedido_rollups WHERE hora >= ? GROUP BY evento, tipo, admin_id",
+            (desde,)
+        ) as cur:
+            for evento, tipo, admin_id, n in await cur.fetchall():
+                eventos[evento] = eventos.get(evento, 0) + n
+                if evento == 'ready':
+                    por_tipo[tipo] = por_tipo.get(tipo, 0) + n
+                    if admin_id:
+                        por_admin[admin_id] = por_admin.get(admin_id, 0) + n
+        async with db.execute(
+            "SELECT metrica, bucket, SUM(n) FROM pedido_latencias_hora WHERE hora >= ? GROUP BY metrica, bucket",
+            (desde,)
+        ) as cur:
+            for metrica, bucket, n in await cur.fetchall():
+                hist.setdefault(metrica, {})[bucket] = n
+    return {
+        "eventos": eventos,
+        "ready_por_tipo": por_tipo,
+        "ready_por_admin": por_admin,
+        "latencias": {m: {"p50": _percentil(h, 0.5), "p95": _percentil(h, 0.95), "n": sum(h.values())} for m, h in hist.items()},
+    }
+
+
+async def cleanup_old_eventos(days: int = 90) -> int:
+    """Poda el historial de eventos; los agregados se conservan."""
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("DELETE FROM pedido_eventos WHERE ts < ?", (now_ts() - days * 86400,))
+        await db.commit()
+    return cur.rowcount
+
+async def cleanup_old_agregados(days: int = 365) -> int:
+    """Poda los agregados por hora (rollups e histograma de latencias)."""
+    cutoff = now_ts() - days * 86400
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("DELETE FROM pedido_rollups WHERE hora < ?", (cutoff,))
+        n = cur.rowcount
+        cur = await db.execute("DELETE FROM pedido_latencias_hora WHERE hora < ?", (cutoff,))
+        await db.commit()
+    return n + cur.rowcount
+
+# ---------------- Estadísticas materializadas ----------------
+def _stat_delta(clave_sql: str, delta: str) -> str:
+    return (f"INSERT INTO estadisticas (clave, valor) VALUES ({clave_sql}, {delta}) "
+            f"ON CONFLICT(clave) DO UPDATE SET valor=valor+({delta});")
+
+_STATS_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_usuarios_ins AFTER INSERT ON usuarios BEGIN
+        {_stat_delta("'usuarios'", "1")}
+        {_stat_delta("'admins'", "NEW.rol='admin'")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_usuarios_del AFTER DELETE ON usuarios BEGIN
+        {_stat_delta("'usuarios'", "-1")}
+        {_stat_delta("'admins'", "-(OLD.rol='admin')")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_usuarios_rol AFTER UPDATE OF rol ON usuarios
+        WHEN OLD.rol IS NOT NEW.rol BEGIN
+        {_stat_delta("'admins'", "(NEW.rol='admin') - (OLD.rol='admin')")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_pedidos_ins AFTER INSERT ON pedidos BEGIN
+        {_stat_delta("'estado:' || COALESCE(NEW.estado, 'unknown')", "1")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_pedidos_del AFTER DELETE ON pedidos BEGIN
+        {_stat_delta("'estado:' || COALESCE(OLD.estado, 'unknown')", "-1")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_stats_pedidos_estado AFTER UPDATE OF estado ON pedidos
+        WHEN OLD.estado IS NOT NEW.estado BEGIN
+        {_stat_delta("'estado:' || COALESCE(OLD.estado, 'unknown')", "-1")}
+        {_stat_delta("'estado:' || COALESCE(NEW.estado, 'unknown')", "1")}
+    END""",
+)
+
+
+async def get_stats() -> dict:
+    """Devuelve {'usuarios': n, 'admins': n, 'estados': {estado: n}} en una sola lectura."""
+    stats = {"usuarios": 0, "admins": 0, "estados": {}}
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT clave, valor FROM estadisticas") as cur:
+            for clave, valor in await cur.fetchall():
+                if clave.startswith("estado:"):
+                    if valor:
+                        stats["estados"][clave[len("estado:"):]] = valor
+                else:
+                    stats[clave] = valor
+    return stats
+
+
+async def reconcile_stats() -> dict:
+    """Recalcula los contadores desde las tablas y corrige las desviaciones.
+
+    Devuelve {clave: (guardado, real)} con las claves que estaban desviadas.
+    """
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute("BEGIN IMMEDIATE")
+        real = {}
+        async with db.execute("SELECT COUNT(*), COALESCE(SUM(rol='admin'), 0) FROM usuarios") as cur:
+            real["usuarios"], real["admins"] = await cur.fetchone()
+        async with db.execute("SELECT COALESCE(estado, 'unknown'), COUNT(*) FROM pedidos GROUP BY 1") as cur:
+            for estado, n in await cur.fetchall():
+                real[f"estado:{estado}"] = n
+        async with db.execute("SELECT clave, valor FROM estadisticas") as cur:
+            guardado = dict(await cur.fetchall())
+        drift = {}
+        for clave in set(real) | set(guardado):
+            if real.get(clave, 0) != guardado.get(clave, 0):
+                drift[clave] = (guardado.get(clave, 0), real.get(clave, 0))
+        await db.executemany(
+            "INSERT INTO estadisticas (clave, valor) VALUES (?, ?) ON CONFLICT(clave) DO UPDATE SET valor=excluded.valor",
+            [(clave, real_n) for clave, (_, real_n) in drift.items()]
         )
         await db.commit()
+    return drift
 
-async def soporte_get_by_admin_msg(admin_msg_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, user_id, user_msg_id, estado FROM soporte WHERE admin_msg_id=?", (admin_msg_id,)) as cur:
-            return await cur.fetchone()
+# ---------------- Soporte (chat admin) ----------------
+# Una fila por sesión de soporte (no por mensaje). Los avisos de pedidos no
+# son sesiones: su enrutado de respuestas vive solo en hilos.
+async def soporte_registrar_mensaje(user_id: int, user_msg_id: int, admin_msg_id: int = None):
+    """Suma el mensaje a la sesión abierta del usuario o abre una nueva."""
+    now = now_ts()
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("""
+            UPDATE soporte SET ultimo_ts=?, mensajes=COALESCE(mensajes, 1) + 1, user_msg_id=?,
+                admin_msg_id=COALESCE(?, admin_msg_id)
+            WHERE id=(SELECT id FROM soporte WHERE user_id=? AND estado='open' ORDER BY fecha_ts DESC LIMIT 1)
+        """, (now, user_msg_id, admin_msg_id, user_id))
+        if not cur.rowcount:
+            await db.execute(
+                "INSERT INTO soporte (user_id, admin_msg_id, user_msg_id, estado, fecha_ts, ultimo_ts, mensajes) "
+                "VALUES (?, ?, ?, 'open', ?, ?, 1)",
+                (user_id, admin_msg_id, user_msg_id, now, now)
+            )
+        await db.commit()
 
 async def soporte_get_open_by_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, admin_msg_id, user_msg_id, estado FROM soporte WHERE user_id=? AND estado='open' ORDER BY fecha DESC LIMIT 1", (user_id,)) as cur:
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT id, admin_msg_id, user_msg_id, estado FROM soporte WHERE user_id=? AND estado='open' ORDER BY fecha_ts DESC LIMIT 1", (user_id,)) as cur:
             return await cur.fetchone()
 
 async def soporte_close_by_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE soporte SET estado='closed' WHERE user_id=? AND estado='open'", (user_id,))
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute("UPDATE soporte SET estado='closed', cerrado_ts=? WHERE user_id=? AND estado='open'", (now_ts(), user_id))
+        await db.commit()
+
+
+_ARCHIVO_PREFIX = "soporte_archivo_"
+
+
+async def soporte_compactar(inactividad_secs: int, retencion_dias: int = 7, meses_archivo: int = 12,
+                            hilos_dias: int = 90) -> dict:
+    """Mantiene soporte pequeño: solo sesiones abiertas y cerradas recientes.
+
+    1. Cierra las sesiones sin actividad desde hace `inactividad_secs`.
+    2. Mueve las cerradas hace más de `retencion_dias` a tablas mensuales
+       soporte_archivo_AAAAMM (por mes de cierre).
+    3. Borra las tablas de archivo con más de `meses_archivo` meses y las
+       filas de hilos con más de `hilos_dias` días.
+    """
+    now = now_ts()
+    cutoff = now - retencion_dias * 86400
+    r = {"cerradas": 0, "archivadas": 0, "tablas_borradas": 0, "hilos": 0}
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("""
+            UPDATE soporte SET estado='closed', cerrado_ts=COALESCE(ultimo_ts, fecha_ts, ?)
+            WHERE estado='open' AND COALESCE(ultimo_ts, fecha_ts, 0) < ?
+        """, (now, now - inactividad_secs))
+        r["cerradas"] = cur.rowcount
+        # sesiones cerradas antes de existir cerrado_ts: se fecha con su última
+        # actividad; sin ninguna fecha cuentan como cerradas ahora
+        await db.execute("""
+            UPDATE soporte SET cerrado_ts=COALESCE(ultimo_ts, fecha_ts, ?)
+            WHERE estado='closed' AND cerrado_ts IS NULL
+        """, (now,))
+
+        async with db.execute(
+            "SELECT DISTINCT strftime('%Y%m', cerrado_ts, 'unixepoch') FROM soporte WHERE estado='closed' AND cerrado_ts < ?",
+            (cutoff,)
+        ) as cur:
+            meses = [m for (m,) in await cur.fetchall() if m and m.isdigit()]
+        for mes in meses:
+            tabla = f"{_ARCHIVO_PREFIX}{mes}"
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {tabla} (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    admin_msg_id INTEGER,
+                    user_msg_id INTEGER,
+                    fecha_ts INTEGER,
+                    ultimo_ts INTEGER,
+                    cerrado_ts INTEGER,
+                    mensajes INTEGER
+                )
+            """)
+            cur = await db.execute(f"""
+                INSERT OR IGNORE INTO {tabla} (id, user_id, admin_msg_id, user_msg_id, fecha_ts, ultimo_ts, cerrado_ts, mensajes)
+                SELECT id, user_id, admin_msg_id, user_msg_id, fecha_ts, ultimo_ts, cerrado_ts, mensajes FROM soporte
+                WHERE estado='closed' AND cerrado_ts < ? AND strftime('%Y%m', cerrado_ts, 'unixepoch') = ?
+            """, (cutoff, mes))
+            r["archivadas"] += cur.rowcount
+        await db.execute("DELETE FROM soporte WHERE estado='closed' AND cerrado_ts < ?", (cutoff,))
+
+        hoy = time.gmtime(now)
+        total = hoy.tm_year * 12 + hoy.tm_mon - 1 - meses_archivo
+        limite = f"{total // 12:04d}{total % 12 + 1:02d}"
+        async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?",
+                              (_ARCHIVO_PREFIX + "%",)) as cur:
+            tablas = [name for (name,) in await cur.fetchall()]
+        for tabla in tablas:
+            mes = tabla[len(_ARCHIVO_PREFIX):]
+            if mes.isdigit() and mes < limite:
+                await db.execute(f"DROP TABLE {tabla}")
+                r["tablas_borradas"] += 1
+
+        cur = await db.execute("DELETE FROM hilos WHERE fecha_ts < ?", (now - hilos_dias * 86400,))
+        r["hilos"] = cur.rowcount
+        await db.commit()
+    return r
+
+# ---------------- Hilos (respuestas en el grupo de admins) ----------------
+# LRU por base delante de la tabla hilos; se rellena al escribir, así que los
+# hilos recientes se resuelven sin tocar SQLite.
+HILOS_CACHE_SIZE = 5000
+_hilos_cache = {}  # db_path -> OrderedDict[(chat_id, admin_msg_id)] = (user_id, tipo, ticket)
+
+
+def _hilos_lru() -> collections.OrderedDict:
+    return _hilos_cache.setdefault(db_path(), collections.OrderedDict())
+
+
+def _hilos_put(key, value):
+    lru = _hilos_lru()
+    lru[key] = value
+    lru.move_to_end(key)
+    if len(lru) > HILOS_CACHE_SIZE:
+        lru.popitem(last=False)
+
+
+async def hilo_register(chat_id: int, admin_msg_id: int, user_id: int, tipo: str, ticket: str = None):
+    """Registra un mensaje enviado al grupo de admins y el usuario al que responde."""
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO hilos (chat_id, admin_msg_id, user_id, tipo, ticket, fecha_ts) VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, admin_msg_id, user_id, tipo, ticket, now_ts())
+        )
+        await db.commit()
+    _hilos_put((chat_id, admin_msg_id), (user_id, tipo, ticket))
+
+
+async def hilo_get(chat_id: int, admin_msg_id: int):
+    """(user_id, tipo, ticket) del hilo o None."""
+    key = (chat_id, admin_msg_id)
+    lru = _hilos_lru()
+    hit = lru.get(key)
+    if hit is not None:
+        lru.move_to_end(key)
+        return hit
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT user_id, tipo, ticket FROM hilos WHERE chat_id=? AND admin_msg_id=?", key) as cur:
+            row = await cur.fetchone()
+    if row:
+        _hilos_put(key, tuple(row))
+        return tuple(row)
+    return None
+
+
+async def migrate_hilos(chat_id: int) -> int:
+    """Copia a hilos los mensajes ya registrados en soporte (una sola vez)."""
+    if not chat_id or await config_get("hilos_migration") == "done":
+        return 0
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("""
+            INSERT OR IGNORE INTO hilos (chat_id, admin_msg_id, user_id, tipo, fecha_ts)
+            SELECT ?, admin_msg_id, user_id, 'soporte', fecha_ts FROM soporte
+            WHERE admin_msg_id IS NOT NULL AND user_id IS NOT NULL
+        """, (chat_id,))
+        n = cur.rowcount
         await db.commit()
+    await config_set("hilos_migration", "done")
+    return n
 
 # ---------------- Config ----------------
 async def config_set(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(db_path()) as db:
         await db.execute("INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
         await db.commit()
+    cache = _config_cache.get(db_path())
+    if cache is not None:
+        cache[key] = value
 
 async def config_get(key: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    cache = _config_cache.get(db_path())
+    if cache is not None:
+        return cache.get(key)
+    async with aiosqlite.connect(db_path()) as db:
         async with db.execute("SELECT value FROM config WHERE key=?", (key,)) as cur:
             r = await cur.fetchone()
             return r[0] if r else None
@@ -260,25 +1115,120 @@ async def export_pedidos_csv(path: str, limit: int = 10000) -> str:
         writer = csv.writer(f)
         writer.writerow(["ticket", "user_id", "tipo", "descripcion", "fecha"])
         for r in rows:
-            writer.writerow(r)
+            writer.writerow((*r[:4], fmt_ts(r[4])))
     return path
 
 async def backup_db(backup_path: str = None) -> str:
-    backup_path = backup_path or f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.commit()
-    import shutil
-    shutil.copyfile(DB_PATH, backup_path)
+    """Copia en caliente con la API de backup de SQLite (consistente aunque haya escrituras)."""
+    stem = os.path.splitext(os.path.basename(db_path()))[0]
+    backup_path = backup_path or f"backup_{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    os.makedirs(os.path.dirname(backup_path) or ".", exist_ok=True)
+    async with aiosqlite.connect(db_path()) as db, aiosqlite.connect(backup_path) as target:
+        await db.backup(target, pages=1024, sleep=0.01)
     return backup_path
 
-async def cleanup_old_pedidos(days: int = 30):
-    cutoff = datetime.now() - timedelta(days=days)
-    cutoff_str = cutoff.strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
-        # contar cuántos registros serán eliminados
-        async with db.execute("SELECT COUNT(*) FROM pedidos WHERE fecha < ?", (cutoff_str,)) as cur:
+
+def rotate_backups(directory: str, keep: int) -> list:
+    """Borra las copias más antiguas de esta base en `directory`; devuelve las borradas."""
+    stem = os.path.splitext(os.path.basename(db_path()))[0]
+    prefix = f"backup_{stem}_"
+    if not os.path.isdir(directory):
+        return []
+    backups = sorted(f for f in os.listdir(directory) if f.startswith(prefix) and f.endswith(".db"))
+    removed = backups[:-keep] if keep > 0 else []
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    return removed
+
+
+# ---------------- Mantenimiento ----------------
+async def optimize_db() -> str:
+    """PRAGMA optimize (ANALYZE solo de lo que lo necesita); ANALYZE completo si nunca se hizo."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'") as cur:
+            analyzed = await cur.fetchone()
+        if not analyzed:
+            await db.execute("ANALYZE")
+            return "ANALYZE completo"
+        await db.execute("PRAGMA optimize")
+    return "PRAGMA optimize"
+
+
+async def incremental_vacuum(max_pages: int = 2000) -> dict:
+    """Devuelve páginas libres antes/después. La primera vez convierte la base
+    a auto_vacuum=INCREMENTAL, lo que exige un VACUUM completo."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute("PRAGMA auto_vacuum") as cur:
+            mode = (await cur.fetchone())[0]
+        async with db.execute("PRAGMA freelist_count") as cur:
+            antes = (await cur.fetchone())[0]
+        if mode != 2:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+            convertida = True
+        else:
+            await db.execute(f"PRAGMA incremental_vacuum({int(max_pages)})")
+            convertida = False
+        async with db.execute("PRAGMA freelist_count") as cur:
+            despues = (await cur.fetchone())[0]
+        async with db.execute("PRAGMA page_size") as cur:
+            page_size = (await cur.fetchone())[0]
+    return {"antes": antes, "despues": despues, "recuperadas": antes - despues,
+            "bytes": (antes - despues) * page_size, "convertida": convertida}
+
+
+async def log_mantenimiento(tarea: str, inicio_ts: int, duracion_ms: int, ok: bool, detalle: str = None):
+    async with aiosqlite.connect(db_path()) as db:
+        await db.execute(
+            "INSERT INTO mantenimiento_log (tarea, inicio_ts, duracion_ms, ok, detalle) VALUES (?, ?, ?, ?, ?)",
+            (tarea, inicio_ts, duracion_ms, 1 if ok else 0, detalle)
+        )
+        await db.commit()
+
+
+async def last_mantenimiento_ok(tarea: str):
+    """inicio_ts de la última ejecución correcta de `tarea`, o None."""
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            "SELECT MAX(inicio_ts) FROM mantenimiento_log WHERE tarea=? AND ok=1", (tarea,)
+        ) as cur:
             r = await cur.fetchone()
-            to_delete = r[0] if r else 0
-        await db.execute("DELETE FROM pedidos WHERE fecha < ?", (cutoff_str,))
+            return r[0] if r else None
+
+
+async def get_mantenimiento_log(limit: int = 20) -> list:
+    async with aiosqlite.connect(db_path()) as db:
+        async with db.execute(
+            "SELECT tarea, inicio_ts, duracion_ms, ok, detalle FROM mantenimiento_log ORDER BY id DESC LIMIT ?", (limit,)
+        ) as cur:
+            return await cur.fetchall()
+
+
+async def cleanup_mantenimiento_log(days: int = 180) -> int:
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("DELETE FROM mantenimiento_log WHERE inicio_ts < ?", (now_ts() - days * 86400,))
         await db.commit()
-    return to_delete
\ No newline at end of file
+    return cur.rowcount
+
+async def cleanup_old_pedidos(days: int = 30):
+    """Borra los pedidos antiguos por la fecha del canónico.
+
+    Los duplicados enlazados se borran junto con su canónico aunque sean más
+    recientes (igual que delete_pedido), para no dejar canonical_ticket
+    apuntando a un pedido que ya no existe.
+    """
+    cutoff = now_ts() - days * 86400
+    async with aiosqlite.connect(db_path()) as db:
+        cur = await db.execute("""
+            DELETE FROM pedidos WHERE canonical_ticket IN (
+                SELECT ticket FROM pedidos WHERE canonical_ticket IS NULL AND fecha_ts < ?
+            )
+        """, (cutoff,))
+        seguidores = cur.rowcount
+        cur = await db.execute("DELETE FROM pedidos WHERE canonical_ticket IS NULL AND fecha_ts < ?", (cutoff,))
+        await db.commit()
+    return cur.rowcount + seguidores
+
+
+# un span por llamada a la base cuando hay una traza activa (ver tracing.py)
+trace_module(sys.modules[__name__], "db")
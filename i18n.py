@@ -0,0 +1,93 @@
+# i18n.py
+import logging
+import string
+
+logger = logging.getLogger(__name__)
+
+_formatter = string.Formatter()
+
+
+def _fields(template: str) -> frozenset:
+    """Campos {x} de una plantilla; ValueError si el formato es inválido."""
+    fields = set()
+    for _, field, _, _ in _formatter.parse(template):
+        if field is None:
+            continue
+        name = field.split(".")[0].split("[")[0]
+        if not name.isidentifier():
+            raise ValueError(f"campo posicional o inválido {{{field}}}")
+        fields.add(name)
+    return frozenset(fields)
+
+
+class Catalog:
+    """Catálogo de textos compilado una sola vez al arrancar.
+
+    Cada plantilla se valida al cargar; las que no tienen campos se guardan
+    como texto final y no pasan por str.format. Las claves que faltan en un
+    idioma se rellenan con las del idioma por defecto y quedan en `missing`.
+    """
+
+    def __init__(self, texts: dict, default: str = "es"):
+        self.default = default
+        self.languages = tuple(texts)
+        self.missing = {}  # idioma -> claves que toma del idioma por defecto
+        self.mismatched = {}  # clave -> {idioma: campos} cuando los idiomas no coinciden
+        self._entries = {}
+        errors = []
+        compiled = {}
+        for lang, entries in texts.items():
+            compiled[lang] = {}
+            for key, template in entries.items():
+                try:
+                    fields = _fields(template)
+                except ValueError as e:
+                    errors.append(f"{lang}.{key}: {e}")
+                    continue
+                compiled[lang][key] = (template, fields)
+        if errors:
+            raise ValueError("Plantillas de texto inválidas: " + "; ".join(errors))
+
+        all_keys = set().union(*(c.keys() for c in compiled.values()))
+        base = compiled[default]
+        for lang, entries in compiled.items():
+            faltan = sorted(all_keys - entries.keys())
+            if faltan:
+                self.missing[lang] = faltan
+            for key in faltan:
+                if key in base:
+                    entries[key] = base[key]
+        for key in all_keys:
+            campos = {lang: entries[key][1] for lang, entries in compiled.items() if key in entries}
+            if len(set(campos.values())) > 1:
+                self.mismatched[key] = {lang: sorted(f) for lang, f in campos.items()}
+        # (texto, None) si es estático; (plantilla, campos) si hay que formatear
+        self._entries = {
+            lang: {k: (t, f or None) for k, (t, f) in entries.items()}
+            for lang, entries in compiled.items()
+        }
+
+    def lang(self, lang: str) -> str:
+        """Normaliza a un idioma del catálogo (los desconocidos caen al por defecto)."""
+        return lang if lang in self._entries else self.default
+
+    def get(self, lang: str, key: str, **kwargs) -> str:
+        entry = self._entries.get(lang) or self._entries[self.default]
+        text, fields = entry.get(key, (key, None))
+        if fields is None:
+            return text
+        kwargs.setdefault("lang", lang)
+        return text.format(**kwargs)
+
+    def report(self) -> str:
+        lines = []
+        for lang, keys in self.missing.items():
+            lines.append(f"{lang}: faltan {len(keys)} claves: {', '.join(keys)}")
+        for key, campos in sorted(self.mismatched.items()):
+            lines.append(f"{key}: campos distintos por idioma {campos}")
+        return "\n".join(lines)
+
+    def log_report(self):
+        report = self.report()
+        if report:
+            logger.warning("🌐 Catálogo de textos incompleto:\n%s", report)
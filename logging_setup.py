@@ -0,0 +1,135 @@
+# logging_setup.py
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+import traceback
+
+# Campos del update en curso (update_id, user_id, bot); cada tarea ve los suyos
+_log_context = contextvars.ContextVar("log_context", default={})
+
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def bind(**fields):
+    """Añade campos a todos los logs de la tarea actual (y de las que cree)."""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """Copia el contexto al record; corre en el hilo que loguea, antes de la cola."""
+
+    def filter(self, record):
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Muestreo y límite por segundo para loggers ruidosos.
+
+    `rules` mapea un nombre de logger (se aplica también a sus hijos) a
+    (fracción muestreada, máximo por segundo). WARNING y superiores no se
+    muestrean pero sí cuentan para el límite. Lo descartado se informa en el
+    campo `dropped` del siguiente record que pasa.
+    """
+
+    def __init__(self, rules: dict):
+        super().__init__()
+        self.rules = rules
+        self._buckets = {}  # logger -> [tokens, último acceso]
+        self._dropped = {}  # logger -> descartados desde el último que pasó
+
+    def _rule(self, name: str):
+        while name:
+            if name in self.rules:
+                return name, self.rules[name]
+            name = name.rpartition(".")[0]
+        return None, None
+
+    def filter(self, record):
+        key, rule = self._rule(record.name)
+        if rule is None:
+            return True
+        sample, per_second = rule
+        keep = record.levelno >= logging.WARNING or random.random() < sample
+        if keep and per_second:
+            now = time.monotonic()
+            bucket = self._buckets.setdefault(key, [per_second, now])
+            bucket[0] = min(per_second, bucket[0] + (now - bucket[1]) * per_second)
+            bucket[1] = now
+            keep = bucket[0] >= 1
+            if keep:
+                bucket[0] -= 1
+        if not keep:
+            self._dropped[key] = self._dropped.get(key, 0) + 1
+            return False
+        dropped = self._dropped.pop(key, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _PreparedQueueHandler(logging.handlers.QueueHandler):
+    # El formateo JSON se hace en el hilo del listener: aquí solo se resuelven
+    # los argumentos para que el record sea seguro de pasar entre hilos.
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level=logging.INFO, json_output: bool = True, sampling: dict = None):
+    """Configura el root logger para escribir desde un hilo aparte vía cola.
+
+    Devuelve el QueueListener (se detiene solo al salir del proceso).
+    """
+    log_queue = queue.SimpleQueue()
+    handler = _PreparedQueueHandler(log_queue)
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+    handler.addFilter(ContextFilter())
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if json_output else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # httpx loguea cada petición a INFO; con getUpdates es ruido constante
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
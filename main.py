@@ -1,33 +1,65 @@
 # main.py
 import asyncio
+import contextvars
+import functools
+import heapq
+import html
+import signal
+import threading
 import logging
-from datetime import datetime
+import traceback
+from datetime import datetime, timedelta
 import os
+import random
 import httpx
-import nest_asyncio
 import time
-from telegram.error import TimedOut, BadRequest
+from telegram.error import (
+    TimedOut, BadRequest, Forbidden, RetryAfter, NetworkError, InvalidToken, ChatMigrated, Conflict
+)
 from telegram import (
     InlineKeyboardButton, InlineKeyboardMarkup, Update, ForceReply
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ContextTypes, filters
+    Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler,
+    TypeHandler, ContextTypes, filters
 )
 from config import *
 
 from database import (
-    init_db, add_user, set_lang, get_lang, add_pedido, get_pedidos, get_pedido,
-    search_pedidos, delete_pedido, get_all_users, set_role, get_role,
+    init_db, add_user, set_lang, get_lang, add_pedido_dedup, get_pedidos, get_pedido, get_pedidos_page,
+    search_pedidos, delete_pedido, get_seguidores, set_role, get_role,
     export_pedidos_csv, backup_db, cleanup_old_pedidos,
-    soporte_create_entry, soporte_get_by_admin_msg, soporte_get_open_by_user, soporte_close_by_user,
-    config_set, config_get
+    soporte_registrar_mensaje, soporte_get_open_by_user, soporte_close_by_user, soporte_compactar,
+    config_set, config_get, fmt_ts, migrate_text_timestamps, backfill_trigramas, use_db, warm_caches
+)
+from database import get_stats, reconcile_stats, update_user_profiles, get_user_profile
+from database import iter_audiencia, count_audiencia, mark_users_inactive
+from database import get_pedido_full, get_pedidos_abiertos, now_ts
+from database import (
+    optimize_db, incremental_vacuum, rotate_backups, log_mantenimiento, last_mantenimiento_ok,
+    get_mantenimiento_log, cleanup_mantenimiento_log
+)
+from database import hilo_register, hilo_get, migrate_hilos
+from database import assign_pedido, set_admin_disponible, unset_admin_disponible, get_admins_disponibles, get_admin_loads
+from persistence import SQLitePersistence
+from database import transition_pedido, get_pedido_analytics, cleanup_old_eventos, cleanup_old_agregados
+
+from logging_setup import setup_logging, bind as log_bind
+from profiler import profile_thread
+from tracing import Tracer, span, traced, mark_error
+from i18n import Catalog
+
+setup_logging(
+    json_output=LOG_JSON,
+    sampling=LOG_SAMPLING,
 )
-from database import count_users, count_admins
-from database import set_pedido_estado, assign_pedido, count_pedidos_by_estado, get_pedido_full
-
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# logs por mensaje en rutas calientes: se muestrean y limitan (ver LOG_SAMPLING)
+hot_logger = logging.getLogger("pedidos.hot")
+
+# se crea en run_bots y se detiene al salir (ver TRACING); None = sin trazas
+tracer = None
 
 TEXTS = {
     "es": {
@@ -36,9 +68,10 @@ TEXTS = {
         "pedir_choose": "Qué deseas pedir❓",
         "pedir_prompt": "✍️ Escribe la descripción de tu pedido de {tipo}.",
     "pedido_ok": "✅ Pedido registrado.\n🎟 Ticket: <code>{ticket}</code>",
+        "pedido_dup": "✅ Pedido registrado.\n🎟 Ticket: <code>{ticket}</code>\n🔗 Ya hay un pedido igual en curso; te avisaremos cuando esté listo.",
         "no_perms": "🚫 No tienes permisos para usar este comando.",
         "global_confirm": "📢 Vas a enviar un mensaje global a {n} usuarios. Confirmar?",
-        "global_sent": "✅ Mensaje global enviado. Enviados: {sent} Fallidos: {failed}",
+        "global_sent": "✅ Mensaje global enviado. Enviados: {sent} Fallidos: {failed} (marcados inactivos: {inactivos})",
         "idioma_set": "✅ Idioma establecido a {lang}.",
         "export_ready": "✅ Export listo: ",
         "backup_done": "✅ Backup creado: {path}",
@@ -50,6 +83,9 @@ TEXTS = {
         "admin_config_saved": "✅ Configuración guardada.",
         "support_sent": "✅ Tu mensaje fue enviado a los administradores.",
         "support_closed": "✅ Conversación cerrada.",
+        "support_idle_closed": "⌛ El chat con los administradores se cerró por inactividad. Usa /chatadmin para abrir uno nuevo.",
+        "flood": "⏳ Vas demasiado rápido. Espera un momento antes de volver a intentarlo.",
+        "pedido_limite": "⚠️ Ya tienes {n} pedidos abiertos. Espera a que se atiendan antes de pedir más.",
         # botones y labels
         "main_pedir": "📝 Pedir",
         "main_idioma": "🌐 Idioma",
@@ -65,8 +101,8 @@ TEXTS = {
         "admin_global": "🌍 Enviar global",
         "admin_cleanup": "🧹 Limpiar pedidos antiguos",
         "confirmar": "✅ Confirmar",
-    "cancelar": "❌ Cancelar",
-    "responder": "💬 Responder",
+        "cancelar": "❌ Cancelar",
+        "responder": "💬 Responder",
         "take": "🖐 Tomar",
         "ready": "✅ Marcar listo",
         "cancel": "❌ Cancelar",
@@ -81,9 +117,10 @@ TEXTS = {
         "pedir_choose": "What do you want to request❓",
         "pedir_prompt": "✍️ Write the description of your {tipo} request.",
         "pedido_ok": "✅ Order registered.\n🎟 Ticket: <code>{ticket}</code>",
+        "pedido_dup": "✅ Order registered.\n🎟 Ticket: <code>{ticket}</code>\n🔗 The same request is already in progress; we'll let you know when it's ready.",
         "no_perms": "🚫 You don't have permission to use this command.",
         "global_confirm": "📢 You are about to send a global message to {n} users. Confirm?",
-        "global_sent": "✅ Global message sent. Sent: {sent} Failed: {failed}",
+        "global_sent": "✅ Global message sent. Sent: {sent} Failed: {failed} (marked inactive: {inactivos})",
         "idioma_set": "✅ Language set to {lang}.",
         "export_ready": "✅ Export ready: ",
         "backup_done": "✅ Backup created: {path}",
@@ -95,6 +132,9 @@ TEXTS = {
         "admin_config_saved": "✅ Configuration saved.",
         "support_sent": "✅ Your message was sent to administrators.",
         "support_closed": "✅ Conversation closed.",
+        "support_idle_closed": "⌛ The chat with the administrators was closed due to inactivity. Use /chatadmin to open a new one.",
+        "flood": "⏳ You're going too fast. Please wait a moment before trying again.",
+        "pedido_limite": "⚠️ You already have {n} open orders. Please wait until they are handled before requesting more.",
         # botones y labels
         "main_pedir": "📝 Request",
         "main_idioma": "🌐 Language",
@@ -111,6 +151,7 @@ TEXTS = {
         "admin_cleanup": "🧹 Cleanup old orders",
         "confirmar": "✅ Confirm",
         "cancelar": "❌ Cancel",
+        "responder": "💬 Reply",
         "take": "🖐 Take",
         "ready": "✅ Mark ready",
         "cancel": "❌ Cancel",
@@ -121,39 +162,41 @@ TEXTS = {
     }
 }
 
+# Catálogo compilado al importar: plantillas validadas y claves que faltan
+# en un idioma rellenadas con las de "es" (el informe sale en el log).
+CATALOG = Catalog(TEXTS, default="es")
+CATALOG.log_report()
+
 # ------------ Keyboards / buttons -------------
-def kb_main(lang="es", is_admin: bool = False):
+# Los teclados solo dependen del idioma: se construyen una vez por idioma y se
+# reutilizan (InlineKeyboardMarkup es inmutable en PTB 21).
+@functools.lru_cache(maxsize=None)
+def _kb_main(lang: str, is_admin: bool, canal: str = None):
+    unirse = (InlineKeyboardButton(get_text(lang, "main_unirse"), url=canal) if canal
+              else InlineKeyboardButton(get_text(lang, "main_unirse"), callback_data="open_canal"))
     buttons = [
         [InlineKeyboardButton(get_text(lang, "main_pedir"), callback_data="menu_pedir")],
         [InlineKeyboardButton(get_text(lang, "main_idioma"), callback_data="menu_idioma")],
-        [InlineKeyboardButton(get_text(lang, "main_unirse"), callback_data="open_canal")],
+        [unirse],
     ]
     if is_admin:
         buttons.append([InlineKeyboardButton(get_text(lang, "main_admin"), callback_data="menu_admin")])
     return InlineKeyboardMarkup(buttons)
 
 
-async def build_kb_main(context: ContextTypes.DEFAULT_TYPE, lang="es", is_admin: bool = False):
-    canal = await config_get("canal_url")
-    if not canal and 'CANAL_USERNAME' in globals() and CANAL_USERNAME:
-        canal = CANAL_USERNAME
-
-    buttons = [
-        [InlineKeyboardButton("📝 Pedir", callback_data="menu_pedir")],
-        [InlineKeyboardButton("🌐 Idioma", callback_data="menu_idioma")],
-    ]
-
-    if canal:
-        buttons.append([InlineKeyboardButton("📢 Unirse al canal", url=canal)])
-    else:
-        buttons.append([InlineKeyboardButton("📢 Unirse al canal", callback_data="open_canal")])
+def kb_main(lang="es", is_admin: bool = False):
+    return _kb_main(CATALOG.lang(lang), bool(is_admin))
 
-    if is_admin:
-        buttons.append([InlineKeyboardButton("🛠 Admin", callback_data="menu_admin")])
 
-    return InlineKeyboardMarkup(buttons)
+async def build_kb_main(context: ContextTypes.DEFAULT_TYPE, lang="es", is_admin: bool = False):
+    # config_get sale de la caché en memoria; el teclado solo se rehace si cambia la URL
+    canal = await config_get("canal_url")
+    if not canal:
+        canal = bot_cfg().canal_username
+    return _kb_main(CATALOG.lang(lang), bool(is_admin), canal or None)
 
-def kb_pedir(lang="es"):
+@functools.lru_cache(maxsize=None)
+def _kb_pedir(lang: str):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(get_text(lang, "ped_serie"), callback_data="pedido_serie"),
          InlineKeyboardButton(get_text(lang, "ped_pelicula"), callback_data="pedido_pelicula")],
@@ -162,50 +205,75 @@ def kb_pedir(lang="es"):
         [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_main")]
     ])
 
+def kb_pedir(lang="es"):
+    return _kb_pedir(CATALOG.lang(lang))
+
+_KB_IDIOMA = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es"),
+     InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
+    [InlineKeyboardButton("🔙 Volver", callback_data="menu_main")]
+])
+
 def kb_idioma():
+    return _KB_IDIOMA
+
+
+def _per_lang(build):
+    """Factoría kb_admin_*()(lang) con el teclado memoizado por idioma."""
+    cached = functools.lru_cache(maxsize=None)(build)
+
+    def _kb(lang="es"):
+        return cached(CATALOG.lang(lang))
+    return _kb
+
+
+@_per_lang
+def _kb_admin_main(lang):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🇪🇸 Español", callback_data="lang_es"),
-         InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-        [InlineKeyboardButton("🔙 Volver", callback_data="menu_main")]
+        [InlineKeyboardButton(get_text(lang, "admin_export"), callback_data="admin_export")],
+        [InlineKeyboardButton(get_text(lang, "admin_backup"), callback_data="admin_backup")],
+        [InlineKeyboardButton(get_text(lang, "admin_global"), callback_data="admin_global")],
+        [InlineKeyboardButton(get_text(lang, "admin_cleanup"), callback_data="admin_cleanup")],
+        [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_main")]
     ])
 
 def kb_admin_main():
-    def _kb(lang="es"):
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(lang, "admin_export"), callback_data="admin_export")],
-            [InlineKeyboardButton(get_text(lang, "admin_backup"), callback_data="admin_backup")],
-            [InlineKeyboardButton(get_text(lang, "admin_global"), callback_data="admin_global")],
-            [InlineKeyboardButton(get_text(lang, "admin_cleanup"), callback_data="admin_cleanup")],
-            [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_main")]
-        ])
-    return _kb
+    return _kb_admin_main
+
 
+@_per_lang
+def _kb_admin_cleanup_options(lang):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "24h"), callback_data="cleanup_days_1")],
+        [InlineKeyboardButton(get_text(lang, "7d"), callback_data="cleanup_days_7")],
+        [InlineKeyboardButton(get_text(lang, "15d"), callback_data="cleanup_days_15")],
+        [InlineKeyboardButton(get_text(lang, "30d"), callback_data="cleanup_days_30")],
+        [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_admin")]
+    ])
 
 def kb_admin_cleanup_options():
-    def _kb(lang="es"):
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(lang, "24h"), callback_data="cleanup_days_1")],
-            [InlineKeyboardButton(get_text(lang, "7d"), callback_data="cleanup_days_7")],
-            [InlineKeyboardButton(get_text(lang, "15d"), callback_data="cleanup_days_15")],
-            [InlineKeyboardButton(get_text(lang, "30d"), callback_data="cleanup_days_30")],
-            [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_admin")]
-        ])
-    return _kb
+    return _kb_admin_cleanup_options
+
+
+@_per_lang
+def _kb_admin_config(lang):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_admin")]
+    ])
 
 def kb_admin_config():
-    def _kb(lang="es"):
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(lang, "volver"), callback_data="menu_admin")]
-        ])
-    return _kb
+    return _kb_admin_config
+
+
+@_per_lang
+def _kb_confirm_global(lang):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_text(lang, "confirmar"), callback_data="global_confirm_yes"),
+         InlineKeyboardButton(get_text(lang, "cancelar"), callback_data="global_confirm_no")]
+    ])
 
 def kb_confirm_global():
-    def _kb(lang="es"):
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton(get_text(lang, "confirmar"), callback_data="global_confirm_yes"),
-             InlineKeyboardButton(get_text(lang, "cancelar"), callback_data="global_confirm_no")]
-        ])
-    return _kb
+    return _kb_confirm_global
 
 
 def kb_admin_actions(ticket: str, user_id: int = None, assigned: int = None):
@@ -213,54 +281,205 @@ def kb_admin_actions(ticket: str, user_id: int = None, assigned: int = None):
             InlineKeyboardButton("✅ Marcar listo", callback_data=f"ready_{ticket}")]
     row2 = [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancel_{ticket}")]
     if user_id:
-        try:
-            label = get_text('es', 'responder')
-        except Exception:
-            label = "💬 Responder"
-        row2.insert(0, InlineKeyboardButton(label, callback_data=f"responder_ticket_{ticket}_{user_id}"))
+        row2.insert(0, InlineKeyboardButton(get_text('es', 'responder'), callback_data=f"responder_ticket_{ticket}_{user_id}"))
     buttons = [row1, row2]
     return InlineKeyboardMarkup(buttons)
 
 # ------------ util helpers -------------
 def get_text(lang, key, **kwargs):
-    if 'lang' not in kwargs:
-        kwargs['lang'] = lang
-    return TEXTS.get(lang, TEXTS["es"]).get(key, key).format(**kwargs)
+    return CATALOG.get(lang, key, **kwargs)
+
+def _fmt_percentil(p) -> str:
+    # (límite, desbordado) de get_pedido_analytics
+    limite, desbordado = p
+    return f"{'≥' if desbordado else '≤'}{fmt_duracion(limite)}"
+
+def fmt_duracion(secs) -> str:
+    if secs is None:
+        return "-"
+    secs = int(secs)
+    if secs < 60:
+        return f"{secs}s"
+    if secs < 3600:
+        return f"{secs // 60}m"
+    if secs < 86400:
+        return f"{secs // 3600}h {secs % 3600 // 60}m"
+    return f"{secs // 86400}d {secs % 86400 // 3600}h"
+
+async def notify_seguidores(context, pedido: dict, build_text):
+    """Avisa a los usuarios de los pedidos duplicados enlazados a `pedido`."""
+    for seg in pedido.get('seguidores') or []:
+        if not seg.get('user_id'):
+            continue
+        try:
+            await safe_send_message(context.bot, int(seg['user_id']), build_text(seg['ticket']), critical=False)
+        except Exception:
+            logger.exception("❌ No se pudo notificar al usuario del pedido enlazado %s", seg.get('ticket'))
+
+def pedido_changed(ticket: str, pedido: dict = None):
+    """Tras una transición aplicada (`pedido` devuelto por transition_pedido) o un borrado (None).
+
+    Si transition_pedido devolvió None (otro admin se adelantó) no hay que
+    llamarla: el borrado quitaría el plazo SLA vigente del ganador.
+    """
+    rt = bot_cfg()
+    if pedido:
+        rt.scheduler.on_transition(pedido)
+        rt.sla.track_pedido(pedido)
+    else:
+        rt.sla.untrack(ticket)
 
 def generate_ticket():
     return "TCK" + datetime.now().strftime("%Y%m%d%H%M%S%f")[-14:]
 
 
 # ---------------- Resiliencia: helpers con reintentos/backoff ---------------
-async def _retry_call(func, *args, retries: int = 3, backoff: float = 0.5, **kwargs):
+PERMANENTE, RATE_LIMIT, TRANSITORIO = "permanente", "rate_limit", "transitorio"
+
+
+def classify_error(exc: BaseException) -> str:
+    """Permanente: repetir no sirve (bloqueado, petición inválida, bug). RetryAfter: esperar lo indicado."""
+    if isinstance(exc, RetryAfter):
+        return RATE_LIMIT
+    # BadRequest hereda de NetworkError (Forbidden no): se comprueba antes
+    if isinstance(exc, (Forbidden, BadRequest, InvalidToken, ChatMigrated, Conflict)):
+        return PERMANENTE
+    if isinstance(exc, (TimedOut, NetworkError, httpx.TransportError, OSError)):
+        return TRANSITORIO
+    return PERMANENTE
+
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    ra = exc.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+class RetryPolicy:
+    """Presupuesto de reintentos y circuit breaker de la Bot API para un bot.
+
+    - Cada reintento consume del presupuesto (`budget` por `window` segundos);
+      agotado, los fallos ya no se reintentan.
+    - `failure_threshold` fallos transitorios seguidos abren el circuito durante
+      `cooldown` segundos: las llamadas no críticas se descartan sin tocar la red
+      y las críticas siguen pasando y sirven de prueba; un éxito lo cierra.
+    """
+
+    def __init__(self, budget: int = 60, window: float = 60, failure_threshold: int = 5,
+                 cooldown: float = 30, max_retry_after: float = 30):
+        self.budget = budget
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_retry_after = max_retry_after
+        self._spent = []  # monotonic de cada reintento dentro de la ventana
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def allow(self, critical: bool) -> bool:
+        return critical or not self.is_open
+
+    def take_retry(self) -> bool:
+        now = time.monotonic()
+        while self._spent and now - self._spent[0] > self.window:
+            self._spent.pop(0)
+        if len(self._spent) >= self.budget:
+            return False
+        self._spent.append(now)
+        return True
+
+    def on_success(self):
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    def on_transient_failure(self) -> bool:
+        """Devuelve True si este fallo abre el circuito."""
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.failure_threshold and not self.is_open:
+            self._open_until = time.monotonic() + self.cooldown
+            return True
+        return False
+
+
+async def _retry_call(func, *args, retries: int = 3, backoff: float = 0.5, critical: bool = True,
+                      on_error=None, **kwargs):
+    """Llama a la Bot API reintentando solo lo que puede salir bien. Devuelve None si falla.
+
+    `on_error(exc)` recibe la última excepción cuando se abandona la llamada.
+    """
+    rt = bot_cfg()
+    policy, metrics = rt.retry, rt.metrics
+    name = getattr(func, '__name__', str(func))
+    if not policy.allow(critical):
+        metrics.inc("api_descartadas")
+        return None
     last_exc = None
     for attempt in range(retries):
         try:
-            return await func(*args, **kwargs)
-        except TimedOut as e:
-            last_exc = e
-            logger.warning("TimedOut en %s (intento %d/%d): %s", getattr(func, '__name__', str(func)), attempt+1, retries, e)
+            with span(f"bot.{name}", attempt=attempt + 1, critical=critical):
+                result = await func(*args, **kwargs)
+            policy.on_success()
+            metrics.inc("api_ok")
+            return result
         except Exception as e:
             last_exc = e
-            logger.exception("Error en %s (intento %d/%d): %s", getattr(func, '__name__', str(func)), attempt+1, retries, e)
-
-        if attempt < retries - 1:
-            await asyncio.sleep(backoff * (2 ** attempt))
+            kind = classify_error(e)
+            metrics.inc(f"api_{kind}")
+            if kind == PERMANENTE:
+                logger.warning("Error permanente en %s, no se reintenta: %s", name, e)
+                break
+            if kind == RATE_LIMIT:
+                delay = retry_after_seconds(e)
+                if delay > policy.max_retry_after:
+                    logger.warning("RetryAfter de %.0fs en %s; se abandona", delay, name)
+                    break
+            else:
+                logger.warning("Error transitorio en %s (intento %d/%d): %s", name, attempt + 1, retries, e)
+                if policy.on_transient_failure():
+                    metrics.inc("circuito_abierto")
+                    logger.error("🔌 Circuito de la Bot API abierto %ss tras fallos seguidos", policy.cooldown)
+                # jitter completo para no reintentar todos a la vez
+                delay = random.uniform(0, backoff * (2 ** attempt))
+        if attempt == retries - 1 or not policy.allow(critical) or not policy.take_retry():
+            break
+        metrics.inc("api_reintentos")
+        await asyncio.sleep(delay)
 
-    logger.error("Fallo tras %d intentos en %s. Última excepción: %s", retries, getattr(func, '__name__', str(func)), last_exc)
+    metrics.inc("api_fallos")
+    if on_error and last_exc is not None:
+        on_error(last_exc)
     return None
 
 
+def is_dead_recipient(exc: BaseException) -> bool:
+    """El destinatario bloqueó el bot, borró su cuenta o el chat ya no existe."""
+    if isinstance(exc, Forbidden):
+        return True
+    msg = str(exc).lower()
+    return isinstance(exc, BadRequest) and ("chat not found" in msg or "user is deactivated" in msg)
+
+
+def collect_dead_recipient(dead: list, uid: int, exc: BaseException):
+    """on_error para envíos masivos: apunta `uid` si ya no puede recibir mensajes."""
+    if is_dead_recipient(exc):
+        dead.append(uid)
+
+
 async def safe_answer(query, *args, retries: int = 3, backoff: float = 0.5, **kwargs):
     if not query:
         return None
     return await _retry_call(query.answer, *args, retries=retries, backoff=backoff, **kwargs)
 
 
-async def safe_send_message(bot, chat_id, text=None, *args, retries: int = 3, backoff: float = 0.5, **kwargs):
+async def safe_send_message(bot, chat_id, text=None, *args, retries: int = 3, backoff: float = 0.5, critical: bool = True,
+                            on_error=None, **kwargs):
     if not bot:
         return None
-    return await _retry_call(bot.send_message, chat_id, text, *args, retries=retries, backoff=backoff, **kwargs)
+    return await _retry_call(bot.send_message, chat_id, text, *args, retries=retries, backoff=backoff,
+                             critical=critical, on_error=on_error, **kwargs)
 
 
 async def safe_send_document(bot, chat_id, document, *args, retries: int = 3, backoff: float = 0.5, **kwargs):
@@ -279,12 +498,572 @@ async def safe_delete_message(bot, chat_id, message_id, retries: int = 2, backof
         return None
 
 
+async def send_admin_thread(bot, chat_id, text, user_id: int, tipo: str, ticket: str = None, **kwargs):
+    """Envía al grupo de admins y registra el hilo para enrutar las respuestas."""
+    sent = await safe_send_message(bot, chat_id, text, **kwargs)
+    if sent:
+        try:
+            await hilo_register(sent.chat_id, sent.message_id, user_id, tipo, ticket)
+        except Exception:
+            logger.exception("No se pudo registrar el hilo %s:%s", sent.chat_id, sent.message_id)
+    return sent
+
+
+# ---------------- Estado de conversación con TTL ----------------
+# TTL (segundos) de cada clave de estado; para support_open es el tiempo de inactividad
+STATE_TTLS = {
+    "pending_tipo": 15 * 60,
+    "support_open": 30 * 60,
+    "admin_pending": 15 * 60,
+    "pending_global": 30 * 60,
+}
+# Máximo de usuarios con estado de conversación en memoria
+MAX_STATE_USERS = 50000
+_EXP_KEY = "_exp"
+
+
+def state_set(store, key: str, value, ttl: float = None):
+    store[key] = value
+    store.setdefault(_EXP_KEY, {})[key] = time.time() + (ttl or STATE_TTLS[key])
+
+
+def state_get(store, key: str, touch: bool = False):
+    """Valor vigente de `key` o None si no existe o caducó.
+
+    No borra lo caducado: de eso se encarga el barrido, que además cierra las
+    sesiones de soporte. Con touch=True se renueva el TTL (actividad).
+    """
+    value = store.get(key)
+    if value is None:
+        return None
+    exps = store.get(_EXP_KEY) or {}
+    exp = exps.get(key)
+    now = time.time()
+    if exp is not None and exp <= now:
+        return None
+    if touch and key in STATE_TTLS:
+        store.setdefault(_EXP_KEY, {})[key] = now + STATE_TTLS[key]
+    return value
+
+
+def state_pop(store, key: str):
+    exps = store.get(_EXP_KEY)
+    if exps:
+        exps.pop(key, None)
+        if not exps:
+            store.pop(_EXP_KEY, None)
+    return store.pop(key, None)
+
+
+def _expire_state(store, now: float) -> list:
+    """Elimina las claves caducadas de `store` y devuelve sus nombres."""
+    exps = store.get(_EXP_KEY) or {}
+    # claves guardadas antes de existir los TTL: se les asigna uno ahora
+    for key in STATE_TTLS:
+        if key in store and key not in exps:
+            store.setdefault(_EXP_KEY, {})[key] = now + STATE_TTLS[key]
+    expired = [key for key, exp in list(exps.items()) if exp <= now]
+    for key in expired:
+        state_pop(store, key)
+    return expired
+
+
+async def sweep_conversation_state(application) -> dict:
+    """Caduca el estado de conversación y aplica el límite de memoria.
+
+    Las sesiones de soporte que caducan se cierran en la base de datos y se
+    avisa al usuario.
+    """
+    now = time.time()
+    closed_support = []
+    changed = set()  # usuarios cuyo user_data cambió y sigue existiendo
+    expired_total = 0
+    for uid, data in list(application.user_data.items()):
+        expired = _expire_state(data, now)
+        expired_total += len(expired)
+        if "support_open" in expired:
+            closed_support.append(uid)
+        if not data:
+            application.drop_user_data(uid)
+        elif expired:
+            changed.add(uid)
+
+    # presupuesto de memoria: se desalojan primero los estados más próximos a caducar
+    with_state = [(min(d[_EXP_KEY].values()), uid) for uid, d in application.user_data.items() if d.get(_EXP_KEY)]
+    overflow = len(with_state) - MAX_STATE_USERS
+    if overflow > 0:
+        for _, uid in sorted(with_state)[:overflow]:
+            data = application.user_data[uid]
+            if "support_open" in data:
+                closed_support.append(uid)
+            for key in list(data[_EXP_KEY]):
+                state_pop(data, key)
+            expired_total += 1
+            if not data:
+                application.drop_user_data(uid)
+                changed.discard(uid)
+            else:
+                changed.add(uid)
+    # PTB solo guarda el user_data de los usuarios con updates; sin esto las
+    # claves caducadas seguirían en ptb_user_data y volverían tras reiniciar
+    if changed:
+        application.mark_data_for_update_persistence(user_ids=changed)
+
+    bot_data = application.bot_data
+    expired_total += len(_expire_state(bot_data, now))
+    # claves admin_pending:{uid} que dejaban versiones anteriores y nadie lee
+    for key in [k for k in bot_data if isinstance(k, str) and k.startswith("admin_pending:")]:
+        bot_data.pop(key, None)
+        expired_total += 1
+
+    for uid in closed_support:
+        try:
+            await soporte_close_by_user(uid)
+            await safe_send_message(application.bot, uid, get_text(await get_lang(uid), "support_idle_closed"), critical=False)
+        except Exception:
+            logger.exception("❌ No se pudo cerrar la sesión de soporte inactiva de %s", uid)
+    return {"expired": expired_total, "support_closed": len(closed_support)}
+
+
+# ---------------- Perfil de usuario (escritura agrupada) ----------------
+class UserProfileWriter:
+    """Acumula username / nombre / last_seen de los updates y los escribe en lote.
+
+    Cada usuario se escribe como mucho una vez por `interval` segundos, salvo
+    que cambie su username o su nombre.
+    """
+
+    def __init__(self, interval: float = 300):
+        self.interval = interval
+        self._pending = {}  # uid -> (username, nombre_completo, last_seen)
+        self._written = {}  # uid -> (monotonic, username, nombre_completo)
+
+    def observe(self, user):
+        if not user or user.is_bot:
+            return
+        now = time.monotonic()
+        prev = self._written.get(user.id)
+        if prev and now - prev[0] < self.interval and prev[1:] == (user.username, user.full_name):
+            return
+        self._pending[user.id] = (user.username, user.full_name, int(time.time()))
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            await update_user_profiles([(uid, *p[:3]) for uid, p in pending.items()])
+        except Exception:
+            # lo más reciente tiene prioridad al reintentar
+            self._pending = {**pending, **self._pending}
+            raise
+        now = time.monotonic()
+        for uid, (username, nombre_completo, _) in pending.items():
+            self._written[uid] = (now, username, nombre_completo)
+        # olvidar lo que ya no limita nada para no crecer sin límite
+        for uid in [u for u, w in self._written.items() if now - w[0] >= self.interval]:
+            del self._written[uid]
+        return len(pending)
+
+
+async def profile_observer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    bot_cfg().profile_writer.observe(update.effective_user)
+
+
+async def user_mention(uid: int) -> str:
+    """@username (o el nombre) guardado localmente, sin llamar a la API."""
+    username, nombre = await get_user_profile(uid)
+    return f"@{username}" if username else (nombre or str(uid))
+
+
+# ---------------- Anti-flood ----------------
+class TokenBucketLimiter:
+    """Token bucket en memoria por (acción, user_id).
+
+    `limits` mapea cada acción a (capacidad, tokens por segundo). Las acciones
+    sin límite configurado siempre se permiten.
+    """
+
+    def __init__(self, limits: dict, max_keys: int = 100000):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._buckets = {}  # (acción, uid) -> [tokens, último acceso, avisado]
+
+    def check(self, action: str, uid: int):
+        """Devuelve (permitido, avisar); avisar solo es True en el primer rechazo de una ráfaga."""
+        cap, rate = self.limits.get(action, (None, None))
+        if not cap:
+            return True, False
+        now = time.monotonic()
+        key = (action, uid)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = [cap, now, False]
+        else:
+            bucket[0] = min(cap, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        notify = not bucket[2]
+        bucket[2] = True
+        return False, notify
+
+    def _prune(self, now: float):
+        # los buckets que ya se habrían rellenado equivalen a no tener entrada
+        for key, (tokens, last, _) in list(self._buckets.items()):
+            cap, rate = self.limits.get(key[0], (0, 0))
+            if tokens + (now - last) * rate >= cap:
+                del self._buckets[key]
+
+
+# ---------------- Varios bots en un proceso ----------------
+class BotMetrics:
+    """Contadores en memoria de un bot; se vuelcan al log y con /metrics."""
+
+    FIELDS = (
+        "updates", "errores", "pedidos", "api_ok", "api_fallos", "api_reintentos",
+        "api_permanente", "api_rate_limit", "api_transitorio", "api_descartadas", "circuito_abierto",
+    )
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def inc(self, field: str, n: int = 1):
+        self.counts[field] = self.counts.get(field, 0) + n
+
+    def snapshot(self) -> dict:
+        return {**self.counts, "uptime": int(time.time() - self.started)}
+
+
+class ErrorAggregator:
+    """Agrupa excepciones por huella (tipo + línea donde saltaron).
+
+    El owner recibe un único resumen por ventana en lugar de un mensaje por
+    excepción; /errores muestra los grupos actuales.
+    """
+
+    def __init__(self, max_buckets: int = 200, keep_seconds: int = 86400):
+        self.max_buckets = max_buckets
+        self.keep_seconds = keep_seconds
+        self.buckets = {}  # huella -> {tipo, lugar, msg, total, ventana, first, last}
+
+    @staticmethod
+    def fingerprint(exc: BaseException):
+        frames = traceback.extract_tb(exc.__traceback__) if exc.__traceback__ else []
+        here = os.path.dirname(os.path.abspath(__file__))
+        own = [f for f in frames if os.path.abspath(f.filename).startswith(here)]
+        frame = (own or frames or [None])[-1]
+        lugar = f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}" if frame else "?"
+        return f"{type(exc).__name__}@{lugar}", lugar
+
+    def record(self, exc: BaseException) -> str:
+        key, lugar = self.fingerprint(exc)
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+            bucket = self.buckets[key] = {
+                "tipo": type(exc).__name__, "lugar": lugar, "msg": "",
+                "total": 0, "ventana": 0, "first": now, "last": now,
+            }
+        bucket["total"] += 1
+        bucket["ventana"] += 1
+        bucket["last"] = now
+        bucket["msg"] = str(exc)[:200]
+        return key
+
+    def prune(self, now: float = None):
+        now = now or time.time()
+        for key in [k for k, b in self.buckets.items() if now - b["last"] > self.keep_seconds]:
+            del self.buckets[key]
+        # si sigue lleno, se descartan los grupos menos recientes
+        excess = len(self.buckets) - self.max_buckets + 1
+        if excess > 0:
+            for key in sorted(self.buckets, key=lambda k: self.buckets[k]["last"])[:excess]:
+                del self.buckets[key]
+
+    def take_window(self) -> list:
+        """Grupos con errores en la ventana actual, y reinicia la ventana."""
+        pending = [dict(b) for b in self.buckets.values() if b["ventana"]]
+        for b in self.buckets.values():
+            b["ventana"] = 0
+        return sorted(pending, key=lambda b: b["ventana"], reverse=True)
+
+
+TELEGRAM_MAX_LEN = 4096
+
+
+def chunk_lines(header: str, lines: list, limit: int = TELEGRAM_MAX_LEN) -> list:
+    """Agrupa líneas completas en mensajes de como mucho `limit` caracteres.
+
+    El primer mensaje lleva `header`; una línea nunca se parte (ni su HTML).
+    """
+    chunks, current = [], header
+    for line in lines:
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line[:limit]
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def format_error_buckets(buckets: list, count_key: str, header: str, footer: str = None) -> list:
+    """Mensajes (ya troceados al límite de Telegram) con un grupo por entrada."""
+    lines = []
+    for b in buckets:
+        lines.append(
+            f"• <b>{b[count_key]}×</b> <code>{html.escape(b['tipo'])}</code> en <code>{html.escape(b['lugar'])}</code>\n"
+            f"  {html.escape(b['msg'])}\n"
+            f"  primero {fmt_ts(int(b['first']))} · último {fmt_ts(int(b['last']))}"
+        )
+    if footer:
+        lines.append(footer)
+    return chunk_lines(header, lines)
+
+
+class AssignmentScheduler:
+    """Reparte los pedidos nuevos entre los admins disponibles (/disponible).
+
+    Mantiene en memoria la carga (pedidos in_progress) de cada admin: cada
+    transición la ajusta con `on_transition` y, como red de seguridad, se
+    reconstruye desde SQLite cada `resync` segundos o tras `invalidate`. Prefiere a los admins especializados en el tipo del
+    pedido y, entre ellos, al de menor carga; los que llegan a `max_por_admin`
+    no reciben más. La asignación usa assign_pedido, así que un "Tomar"
+    simultáneo sigue resolviéndose en la base de datos.
+    """
+
+    def __init__(self, max_por_admin: int = 10, resync: float = 60):
+        self.max_por_admin = max_por_admin
+        self.resync = resync
+        self.loads = {}
+        self.disponibles = {}
+        self._last_assigned = {}
+        self._synced = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._synced = 0.0
+
+    def on_transition(self, pedido: dict):
+        """Ajusta la carga con el pedido devuelto por transition_pedido (y sus seguidores)."""
+        for p in [pedido] + pedido.get('seguidores', []):
+            admin_id = p.get('assigned_admin_id')
+            if not admin_id:
+                continue
+            if p.get('estado') == 'in_progress':
+                delta = 1
+            elif p.get('assigned_ts'):
+                # ready/cancelled con assigned_ts: venía de in_progress
+                delta = -1
+            else:
+                continue
+            self.loads[admin_id] = max(0, self.loads.get(admin_id, 0) + delta)
+
+    async def refresh(self):
+        if time.monotonic() - self._synced < self.resync:
+            return
+        self.disponibles = await get_admins_disponibles()
+        self.loads = await get_admin_loads()
+        self._synced = time.monotonic()
+
+    def pick(self, tipo: str):
+        libres = [a for a in self.disponibles if self.loads.get(a, 0) < self.max_por_admin]
+        expertos = [a for a in libres if tipo in self.disponibles[a]]
+        candidatos = expertos or [a for a in libres if not self.disponibles[a]]
+        if not candidatos:
+            return None
+        return min(candidatos, key=lambda a: (self.loads.get(a, 0), self._last_assigned.get(a, 0)))
+
+    async def assign(self, ticket: str, tipo: str):
+        """Asigna el pedido y devuelve el dict de assign_pedido, o None si no hay a quién."""
+        async with self._lock:
+            await self.refresh()
+            admin_id = self.pick(tipo)
+            if admin_id is None:
+                return None
+            pedido = await assign_pedido(ticket, admin_id)
+            if pedido:
+                self.on_transition(pedido)
+                self._last_assigned[admin_id] = time.monotonic()
+            return pedido
+
+
+class SLAWatchdog:
+    """Plazos de cada pedido abierto en un heap (deadline, ticket, estado).
+
+    Se carga una vez al arrancar y se actualiza en cada transición; la tarea
+    duerme hasta el plazo más próximo, sin recorrer la tabla. Las entradas
+    de pedidos que cambiaron de estado se descartan al salir del heap.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits  # estado -> segundos
+        self._heap = []
+        self._armed = {}  # ticket -> (deadline, estado) vigente
+        self._wake = asyncio.Event()
+
+    def track(self, ticket: str, estado: str, since):
+        limit = self.limits.get(estado)
+        if not limit or not since:
+            self.untrack(ticket)
+            return
+        entry = (since + limit, ticket, estado)
+        self._armed[ticket] = (entry[0], estado)
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] == entry:
+            self._wake.set()
+        if len(self._heap) > 2 * len(self._armed) + 100:
+            self._heap = [(d, t, e) for t, (d, e) in self._armed.items()]
+            heapq.heapify(self._heap)
+
+    def track_pedido(self, pedido: dict):
+        estado = pedido.get('estado') or 'pending'
+        since = pedido.get('assigned_ts') if estado == 'in_progress' else pedido.get('fecha_ts')
+        self.track(pedido['ticket'], estado, since)
+
+    def untrack(self, ticket: str):
+        self._armed.pop(ticket, None)
+
+    def _is_current(self, entry) -> bool:
+        return self._armed.get(entry[1]) == (entry[0], entry[2])
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                del self._armed[entry[1]]
+                due.append(entry)
+        return due
+
+    async def wait(self):
+        """Duerme hasta el próximo plazo o hasta que llegue uno más cercano."""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        self._wake.clear()
+        timeout = max(0, self._heap[0][0] - time.time()) if self._heap else None
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class BotRuntime:
+    """Configuración y estado en memoria de un bot (una comunidad)."""
+
+    def __init__(self, name: str, token: str, owner_id: int = 0, admin_group_id=0,
+                 canal_username: str = "", grupo_username: str = "", db_path: str = None,
+                 rate_limits: dict = None, retry_policy: dict = None):
+        self.name = name
+        self.token = token
+        self.owner_id = owner_id
+        self.admin_group_id = admin_group_id
+        self.canal_username = canal_username
+        self.grupo_username = grupo_username
+        self.db_path = db_path or DB_PATH
+        self.rate_limiter = TokenBucketLimiter(rate_limits or RATE_LIMITS)
+        self.profile_writer = UserProfileWriter()
+        self.metrics = BotMetrics()
+        self.errors = ErrorAggregator()
+        self.retry = RetryPolicy(**(retry_policy or {}))
+        self.sla = SLAWatchdog(SLA_LIMITS)
+        self.scheduler = AssignmentScheduler(max_por_admin=MAX_PEDIDOS_POR_ADMIN)
+
+
+def load_bot_configs() -> list:
+    """Lee `BOTS` de config.py; sin él, un único bot con las constantes de siempre."""
+    bots = BOTS or [{
+        "name": "default",
+        "token": BOT_TOKEN,
+        "owner_id": OWNER_ID,
+        "admin_group_id": ADMIN_GROUP_ID,
+        "canal_username": CANAL_USERNAME,
+        "grupo_username": GRUPO_USERNAME,
+        "db_path": DB_PATH,
+    }]
+    runtimes, paths = [], set()
+    for i, cfg in enumerate(bots):
+        rt = BotRuntime(**{"name": f"bot{i + 1}", "rate_limits": RATE_LIMITS, "retry_policy": RETRY_POLICY, **cfg})
+        if rt.db_path in paths:
+            raise ValueError(f"La base {rt.db_path} está repetida en BOTS; cada bot necesita la suya")
+        paths.add(rt.db_path)
+        runtimes.append(rt)
+    return runtimes
+
+
+_current_runtime = contextvars.ContextVar("bot_runtime", default=None)
+DEFAULT_RUNTIME = None
+
+
+def bot_cfg() -> BotRuntime:
+    """Bot que atiende la tarea actual; los handlers heredan el contexto de su Application."""
+    global DEFAULT_RUNTIME
+    rt = _current_runtime.get()
+    if rt is not None:
+        return rt
+    if DEFAULT_RUNTIME is None:
+        DEFAULT_RUNTIME = load_bot_configs()[0]
+    return DEFAULT_RUNTIME
+
+
+def activate_runtime(rt: BotRuntime):
+    _current_runtime.set(rt)
+    use_db(rt.db_path)
+    log_bind(bot=rt.name)
+
+
+def flood_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Acción limitada que representa el mensaje, según el estado en memoria."""
+    msg = update.effective_message
+    text = getattr(msg, 'text', None)
+    if not isinstance(text, str):
+        return None
+    if text.startswith('/'):
+        return "comando"
+    if getattr(update.effective_chat, 'type', None) != 'private':
+        return None
+    if state_get(context.user_data, "pending_tipo"):
+        return "pedido"
+    if state_get(context.user_data, "support_open"):
+        return "soporte"
+    return None
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Corta los mensajes que exceden el límite antes de tocar SQLite o la API."""
+    user = update.effective_user
+    if not user or user.id == bot_cfg().owner_id:
+        return
+    action = flood_action(update, context)
+    if not action:
+        return
+    allowed, notify = bot_cfg().rate_limiter.check(action, user.id)
+    if allowed:
+        return
+    logger.warning("Flood: %s rechazado para user %s", action, user.id)
+    if notify and update.effective_message:
+        lang = "es" if (user.language_code or "es").startswith("es") else "en"
+        try:
+            await update.effective_message.reply_text(get_text(lang, "flood"))
+        except Exception:
+            logger.debug("No se pudo avisar de flood a %s", user.id)
+    raise ApplicationHandlerStop
+
 
 # ---------------- Channel membership helpers ----------------
 async def is_member_of_channel(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     canal = await config_get("canal_url")
-    if not canal and 'CANAL_USERNAME' in globals() and CANAL_USERNAME:
-        canal = CANAL_USERNAME
+    if not canal:
+        canal = bot_cfg().canal_username
     if not canal:
         return True
     if canal.startswith("https://t.me/") or canal.startswith("http://t.me/"):
@@ -304,7 +1083,7 @@ async def ensure_channel_member(update, context) -> bool:
     if not user:
         return True
     uid = user.id
-    if uid == OWNER_ID:
+    if uid == bot_cfg().owner_id:
         return True
 
     allowed = await is_member_of_channel(uid, context)
@@ -312,8 +1091,8 @@ async def ensure_channel_member(update, context) -> bool:
         return True
 
     canal = await config_get("canal_url")
-    if not canal and 'CANAL_USERNAME' in globals() and CANAL_USERNAME:
-        canal = CANAL_USERNAME
+    if not canal:
+        canal = bot_cfg().canal_username
     canal = canal or "https://t.me/tu_canal"
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Unirse al canal", url=canal)]])
 
@@ -339,8 +1118,10 @@ async def ensure_channel_member(update, context) -> bool:
 
 
 def require_channel_member(func):
+    @functools.wraps(func)
     async def wrapper(update, context, *args, **kwargs):
-        ok = await ensure_channel_member(update, context)
+        with span("mw.require_channel_member"):
+            ok = await ensure_channel_member(update, context)
         if not ok:
             return
         result = None
@@ -366,6 +1147,7 @@ def require_channel_member(func):
 
 
 def require_private_chat(func):
+    @functools.wraps(func)
     async def wrapper(update, context, *args, **kwargs):
         chat = getattr(update, 'effective_chat', None)
         if not chat or getattr(chat, 'type', None) != 'private':
@@ -384,11 +1166,11 @@ def require_private_chat(func):
 @require_channel_member
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    await add_user(user.id, user.first_name)
+    await add_user(user.id, user.first_name, user.username, user.full_name)
     lang = await get_lang(user.id)
     text = get_text(lang, "start", name=user.first_name)
     role = await get_role(user.id)
-    is_admin = (user.id == OWNER_ID) or (role == "admin")
+    is_admin = (user.id == bot_cfg().owner_id) or (role == "admin")
     kb = await build_kb_main(context, lang, is_admin)
     await update.message.reply_text(text, reply_markup=kb)
 
@@ -400,7 +1182,7 @@ async def menu_main_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
     lang = await get_lang(uid)
     role = await get_role(uid)
-    is_admin = (uid == OWNER_ID) or (role == "admin")
+    is_admin = (uid == bot_cfg().owner_id) or (role == "admin")
     kb = await build_kb_main(context, lang, is_admin)
     await query.edit_message_text(get_text(lang, "menu"), reply_markup=kb)
 
@@ -418,49 +1200,66 @@ async def pedido_tipo_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     tipo = query.data.split("_", 1)[1]
-    context.user_data["pending_tipo"] = tipo
+    state_set(context.user_data, "pending_tipo", tipo)
     lang = await get_lang(uid)
     await query.edit_message_text(get_text(lang, "pedir_prompt", tipo=tipo))
 
+# ---------- support: user message to admins ----------
+async def soporte_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    uid = user.id
+    # cada mensaje cuenta como actividad de la sesión de soporte
+    state_get(context.user_data, "support_open", touch=True)
+    admin_group = await config_get("admin_group")
+    if not admin_group and bot_cfg().admin_group_id:
+        admin_group = str(bot_cfg().admin_group_id)
+    if not admin_group:
+        await update.message.reply_text("❌ No hay grupo de administradores configurado.")
+        return
+    try:
+        logger.info("Forwarding support message from %s to admin_group %s", uid, admin_group)
+        sent = await send_admin_thread(context.bot, int(admin_group),
+                                       f"📨 Mensaje de @{user.username or user.first_name} (ID <code>{uid}</code>):\n\n{update.message.text}",
+                                       parse_mode="HTML",
+                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(await get_lang(int(admin_group)), 'responder'), callback_data=f"responder_support_{uid}_{update.message.message_id}")]]),
+                                       user_id=uid, tipo="soporte")
+        logger.info("Forward result: %s", bool(sent))
+        await soporte_registrar_mensaje(uid, update.message.message_id, sent.message_id if sent else None)
+        await update.message.reply_text(get_text(await get_lang(uid), "support_sent"))
+    except Exception as e:
+        logger.exception("Error forwarding support message: %s", e)
+        await update.message.reply_text("❌ Error al enviar el mensaje a administradores.")
+
 # ---------- receive pedido (user types description) ----------
-@require_channel_member
 async def recibir_pedido_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
-    tipo = context.user_data.get("pending_tipo")
+    tipo = state_get(context.user_data, "pending_tipo")
     if not tipo:
-        if context.user_data.get("support_open"):
-            admin_group = await config_get("admin_group")
-            if not admin_group and 'ADMIN_GROUP_ID' in globals() and ADMIN_GROUP_ID:
-                admin_group = str(ADMIN_GROUP_ID)
-            if not admin_group:
-                await update.message.reply_text("❌ No hay grupo de administradores configurado.")
-                return
-            try:
-                logger.info("Forwarding support message from %s to admin_group %s", uid, admin_group)
-                sent = await safe_send_message(context.bot, int(admin_group),
-                                               f"📨 Mensaje de @{user.username or user.first_name} (ID <code>{uid}</code>):\n\n{update.message.text}",
-                                               parse_mode="HTML",
-                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(await get_lang(int(admin_group)), 'responder'), callback_data=f"responder_support_{uid}_{update.message.message_id}")]]))
-                logger.info("Forward result: %s", bool(sent))
-                if sent:
-                    await soporte_create_entry(uid, update.message.message_id, sent.message_id)
-                else:
-                    await soporte_create_entry(uid, update.message.message_id, None)
-                await update.message.reply_text(get_text(await get_lang(uid), "support_sent"))
-            except Exception as e:
-                logger.exception("Error forwarding support message: %s", e)
-                await update.message.reply_text("❌ Error al enviar el mensaje a administradores.")
         return
 
     descripcion = update.message.text
-    ticket = await add_pedido(uid, tipo, descripcion)
+    max_abiertos = MAX_OPEN_PEDIDOS
+    ticket, canonical = await add_pedido_dedup(uid, tipo, descripcion, max_abiertos=max_abiertos)
     lang = await get_lang(uid)
+    if not ticket:
+        await update.message.reply_text(get_text(lang, "pedido_limite", n=max_abiertos))
+        state_pop(context.user_data, "pending_tipo")
+        return
+    bot_cfg().metrics.inc("pedidos")
+    if canonical:
+        # ya hay un pedido igual abierto: queda enlazado y no se avisa de nuevo al grupo
+        hot_logger.info("Pedido %s enlazado como duplicado de %s", ticket, canonical)
+        await update.message.reply_text(get_text(lang, "pedido_dup", ticket=ticket), parse_mode="HTML")
+        state_pop(context.user_data, "pending_tipo")
+        return
     await update.message.reply_text(get_text(lang, "pedido_ok", ticket=ticket), parse_mode="HTML")
+    bot_cfg().sla.track(ticket, "pending", now_ts())
+    asignado = await auto_assign_pedido(context, ticket, tipo, descripcion)
 
     admin_group = await config_get("admin_group")
-    if not admin_group and 'ADMIN_GROUP_ID' in globals() and ADMIN_GROUP_ID:
-        admin_group = str(ADMIN_GROUP_ID)
+    if not admin_group and bot_cfg().admin_group_id:
+        admin_group = str(bot_cfg().admin_group_id)
 
     if admin_group:
         try:
@@ -480,29 +1279,81 @@ async def recibir_pedido_msg(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     f"🎟 <code>{ticket}</code>\n"
                     f"🕒 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
                 )
+                if asignado:
+                    text += f"\n🤖 Asignado a {html.escape(await user_mention(asignado))}"
                 # enviar mensaje al grupo de admins con teclado de acciones
                 try:
                     kb_actions = kb_admin_actions(ticket, user.id)
                 except Exception:
                     kb_actions = None
-                sent = await safe_send_message(context.bot, gid, text, parse_mode="HTML", reply_markup=kb_actions)
-                if sent:
-                    await soporte_create_entry(uid, update.message.message_id, sent.message_id)
-                else:
-                    await soporte_create_entry(uid, update.message.message_id, None)
+                # aviso de pedido, no sesión de soporte: basta con el hilo para enrutar respuestas
+                await send_admin_thread(context.bot, gid, text, uid, "pedido", ticket,
+                                        parse_mode="HTML", reply_markup=kb_actions)
             except Exception as e:
                 logger.exception("Error sending order to admin group: %s", e)
                 try:
-                    await safe_send_message(context.bot, OWNER_ID, f"❌ Error al notificar pedidos al grupo: {e}")
+                    await safe_send_message(context.bot, bot_cfg().owner_id, f"❌ Error al notificar pedidos al grupo: {e}")
                 except: pass
     else:
         try:
-            await safe_send_message(context.bot, OWNER_ID, f"⚠️ Admin group not configured. Pedido {ticket} created by {uid}.")
+            await safe_send_message(context.bot, bot_cfg().owner_id, f"⚠️ Admin group not configured. Pedido {ticket} created by {uid}.")
         except: pass
 
-    context.user_data.pop("pending_tipo", None)
+    state_pop(context.user_data, "pending_tipo")
     return
 
+async def auto_assign_pedido(context, ticket: str, tipo: str, descripcion: str):
+    """Asigna el pedido al admin disponible de menor carga; devuelve su id o None."""
+    if not AUTO_ASSIGN:
+        return None
+    try:
+        pedido = await bot_cfg().scheduler.assign(ticket, tipo)
+    except Exception:
+        logger.exception("❌ Error en la asignación automática de %s", ticket)
+        return None
+    if not pedido:
+        return None
+    bot_cfg().sla.track_pedido(pedido)
+    admin_id = pedido['assigned_admin_id']
+    await safe_send_message(
+        context.bot, admin_id,
+        f"🤖 Se te asignó el pedido <code>{ticket}</code> (#{tipo}):\n{html.escape(descripcion[:200])}",
+        parse_mode="HTML", reply_markup=kb_admin_actions(ticket, pedido.get('user_id')), critical=False
+    )
+    return admin_id
+
+
+_TIPOS_PEDIDO = ("serie", "pelicula", "juego", "otro")
+
+
+async def disponible_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    role = await get_role(user.id)
+    if user.id != bot_cfg().owner_id and role != "admin":
+        return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
+    tipos = [t.lower() for t in (context.args or [])]
+    if any(t not in _TIPOS_PEDIDO for t in tipos):
+        return await update.message.reply_text(f"⚠️ Uso: /disponible [{' '.join(_TIPOS_PEDIDO)}]")
+    await set_admin_disponible(user.id, tipos)
+    scheduler = bot_cfg().scheduler
+    scheduler.invalidate()
+    await scheduler.refresh()
+    await update.message.reply_text(
+        f"✅ Recibirás pedidos automáticamente ({', '.join(tipos) if tipos else 'todos los tipos'}).\n"
+        f"📦 Pedidos en curso: {scheduler.loads.get(user.id, 0)}/{scheduler.max_por_admin}"
+    )
+
+
+async def nodisponible_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    role = await get_role(user.id)
+    if user.id != bot_cfg().owner_id and role != "admin":
+        return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
+    removed = await unset_admin_disponible(user.id)
+    bot_cfg().scheduler.invalidate()
+    await update.message.reply_text("⏸ Ya no recibirás pedidos automáticamente." if removed else "ℹ️ No estabas en el reparto automático.")
+
+
 # --------- Idioma ----------
 @require_channel_member
 async def menu_idioma_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -533,7 +1384,7 @@ async def menu_admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
         return
     lang = await get_lang(uid)
@@ -544,7 +1395,7 @@ async def menu_admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_config_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await safe_answer(query)
-    await query.edit_message_text("🔧 Configuración del bot", reply_markup=kb_admin_config())
+    await query.edit_message_text("🔧 Configuración del bot", reply_markup=kb_admin_config()(await get_lang(query.from_user.id)))
 
 @require_channel_member
 async def admin_export_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -552,7 +1403,7 @@ async def admin_export_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos", show_alert=True)
         return
     filename = f"bot_pedidos_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
@@ -575,7 +1426,7 @@ async def admin_backup_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos", show_alert=True)
         return
     p = await backup_db()
@@ -588,19 +1439,63 @@ async def admin_global_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos", show_alert=True)
         return
-    context.user_data["admin_pending"] = {"action": "global"}
-    context.application.bot_data[f"admin_pending:{uid}"] = {"action": "global"}
-    logger.info("admin_global_cb: admin_pending set for user %s", uid)
+    state_set(context.user_data, "admin_pending", {"action": "global", "chat_id": uid})
+    hot_logger.info("admin_global_cb: admin_pending set for user %s", uid)
     try:
         await safe_send_message(context.bot, uid, "✍️ Escribe ahora el mensaje global que quieres enviar:", reply_markup=ForceReply(selective=True))
         await query.edit_message_text("He enviado un mensaje privado; responde ahí con el texto a enviar")
     except Exception:
         logger.exception("❌ No se pudo enviar ForceReply privado para admin_global, pidiendo en el chat en su lugar")
+        state_set(context.user_data, "admin_pending", {"action": "global", "chat_id": query.message.chat_id})
         await query.edit_message_text("✍️ Escribe ahora el mensaje global que quieres enviar:")
-    logger.debug("admin_global_cb: finished for user %s", uid)
+    hot_logger.debug("admin_global_cb: finished for user %s", uid)
+
+_GLOBAL_USO = (
+    "⚠️ Uso: /global [idioma=es|en] [rol=user|admin] [desde=AAAA-MM-DD] [hasta=AAAA-MM-DD] [activos=días]\n"
+    "Sin filtros se envía a todos los usuarios activos."
+)
+
+
+def parse_segmento(args: list) -> dict:
+    """Convierte `clave=valor` de /global en filtros para iter_audiencia."""
+    segmento = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        key, value = key.lower(), value.strip()
+        if not value:
+            raise ValueError(arg)
+        if key == "idioma" and value in TEXTS:
+            segmento["idioma"] = value
+        elif key == "rol" and value in ("user", "admin"):
+            segmento["rol"] = value
+        elif key in ("desde", "hasta"):
+            segmento[key] = int(datetime.strptime(value, "%Y-%m-%d").timestamp())
+        elif key == "activos" and value.isdigit():
+            segmento["activos_desde"] = int(time.time()) - int(value) * 86400
+        else:
+            raise ValueError(arg)
+    return segmento
+
+
+async def global_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    role = await get_role(user.id)
+    if user.id != bot_cfg().owner_id and role != "admin":
+        return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
+    try:
+        segmento = parse_segmento(context.args or [])
+    except ValueError:
+        return await update.message.reply_text(_GLOBAL_USO)
+    n = await count_audiencia(**segmento)
+    state_set(context.user_data, "admin_pending", {"action": "global", "segmento": segmento, "chat_id": update.effective_chat.id})
+    await update.message.reply_text(
+        f"🎯 Destinatarios: {n}\n✍️ Escribe ahora el mensaje global que quieres enviar:",
+        reply_markup=ForceReply(selective=True)
+    )
+
 
 @require_channel_member
 async def admin_cleanup_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -608,7 +1503,7 @@ async def admin_cleanup_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos", show_alert=True)
         return
     lang = await get_lang(uid)
@@ -621,7 +1516,7 @@ async def admin_cleanup_do_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         await safe_answer(query, "❌ No tienes permisos", show_alert=True)
         return
     data = query.data
@@ -638,26 +1533,28 @@ async def admin_cleanup_do_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
 @require_channel_member
 async def admin_take_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         return await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
     ticket = query.data.split("_", 1)[1]
     try:
-        await assign_pedido(ticket, uid)
-        await set_pedido_estado(ticket, 'in_progress')
+        pedido = await transition_pedido(ticket, 'in_progress', uid)
     except Exception as e:
         logger.exception("Error asignando pedido %s: %s", ticket, e)
         return await safe_answer(query, "❌ Error asignando el pedido.", show_alert=True)
+    if not pedido:
+        return await safe_answer(query, "⚠️ Este pedido ya fue tomado o cerrado.", show_alert=True)
+    pedido_changed(ticket, pedido)
+    await safe_answer(query)
 
     # notificar al usuario
     try:
-        pedido = await get_pedido_full(ticket)
-        if pedido and pedido.get('user_id'):
+        if pedido.get('user_id'):
             admin_name = (query.from_user.username and f"@{query.from_user.username}") or query.from_user.full_name
             msg = f"🟡 Tu pedido {ticket} está siendo atendido por {admin_name}."
             await safe_send_message(context.bot, int(pedido.get('user_id')), msg)
+            await notify_seguidores(context, pedido, lambda t: f"🟡 Tu pedido {t} está siendo atendido por {admin_name}.")
     except Exception:
         logger.exception("❌ No se pudo notificar al usuario sobre asignación del pedido %s", ticket)
 
@@ -672,28 +1569,33 @@ async def admin_take_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_channel_member
 async def admin_ready_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         return await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
     ticket = query.data.split("_", 1)[1]
     try:
-        await set_pedido_estado(ticket, 'ready')
+        pedido = await transition_pedido(ticket, 'ready', uid)
     except Exception:
         logger.exception("❌ Error estableciendo estado ready para %s", ticket)
+        return await safe_answer(query, "❌ Error marcando el pedido como listo.", show_alert=True)
+    if not pedido:
+        return await safe_answer(query, "⚠️ Este pedido ya fue cerrado.", show_alert=True)
+    pedido_changed(ticket, pedido)
+    await safe_answer(query)
 
     try:
-        pedido = await get_pedido_full(ticket)
-        if pedido and pedido.get('user_id'):
+        if pedido.get('user_id'):
             try:
                 admin_name = (query.from_user.username and f"@{query.from_user.username}") or query.from_user.full_name
-                notify_text = f"🏷️ Ey {admin_name}, su pedido ({ticket}) ya está listo\n📌Grupo: @{GRUPO_USERNAME}"
+                notify_text = f"🏷️ Ey {admin_name}, su pedido ({ticket}) ya está listo\n📌Grupo: @{bot_cfg().grupo_username}"
                 await safe_send_message(context.bot, int(pedido.get('user_id')), notify_text)
+                await notify_seguidores(context, pedido, lambda t: f"🏷️ Ey {admin_name}, su pedido ({t}) ya está listo\n📌Grupo: @{bot_cfg().grupo_username}")
             except Exception:
                 logger.exception("❌ No se pudo notificar al usuario que su pedido %s está listo", ticket)
         # eliminar pedido tras notificar
         await delete_pedido(ticket)
+        pedido_changed(ticket)
     except Exception:
         logger.exception("❌ Error procesando ready para %s", ticket)
 
@@ -707,27 +1609,32 @@ async def admin_ready_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_channel_member
 async def admin_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         return await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
     ticket = query.data.split("_", 1)[1]
     try:
-        await set_pedido_estado(ticket, 'cancelled')
+        pedido = await transition_pedido(ticket, 'cancelled', uid)
     except Exception:
         logger.exception("❌ Error estableciendo estado cancelled para %s", ticket)
+        return await safe_answer(query, "❌ Error cancelando el pedido.", show_alert=True)
+    if not pedido:
+        return await safe_answer(query, "⚠️ Este pedido ya fue cerrado.", show_alert=True)
+    pedido_changed(ticket, pedido)
+    await safe_answer(query)
 
     try:
-        pedido = await get_pedido_full(ticket)
-        if pedido and pedido.get('user_id'):
+        if pedido.get('user_id'):
             try:
                 admin_name = (query.from_user.username and f"@{query.from_user.username}") or query.from_user.full_name
                 notify_text = f"🔴 Tu pedido {ticket} ha sido cancelado por {admin_name}."
                 await safe_send_message(context.bot, int(pedido.get('user_id')), notify_text)
+                await notify_seguidores(context, pedido, lambda t: f"🔴 Tu pedido {t} ha sido cancelado por {admin_name}.")
             except Exception:
                 logger.exception("❌ No se pudo notificar al usuario sobre cancelación del pedido %s", ticket)
         await delete_pedido(ticket)
+        pedido_changed(ticket)
     except Exception:
         logger.exception("❌ Error procesando cancel para %s", ticket)
 
@@ -744,29 +1651,41 @@ async def global_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(query)
     uid = query.from_user.id
     data = query.data
-    pending = context.application.bot_data.get("pending_global")
+    pending = state_get(context.application.bot_data, "pending_global")
     if not pending:
         return await query.edit_message_text("❌ No hay mensaje pendiente.")
     if data.endswith("yes"):
         text = pending["text"]
-        users = await get_all_users()
+        segmento = pending.get("segmento") or {}
         sent = 0
         failed = 0
-        msg = await query.edit_message_text(f"✅ Enviando a {len(users)} usuarios...")
-        for u in users:
+        dead = []  # bloquearon el bot o ya no existen
+        inactivos = 0
+        msg = await query.edit_message_text(f"✅ Enviando a {await count_audiencia(**segmento)} usuarios...")
+        async for u in iter_audiencia(**segmento):
             try:
-                res = await safe_send_message(context.bot, u, text)
+                res = await safe_send_message(context.bot, u, text, critical=False,
+                                              on_error=functools.partial(collect_dead_recipient, dead, u))
                 if res is not None:
                     sent += 1
                 else:
                     failed += 1
+                if len(dead) >= 100:
+                    await mark_users_inactive(dead)
+                    inactivos += len(dead)
+                    dead.clear()
                 await asyncio.sleep(0.12)
             except Exception:
                 failed += 1
-        await msg.edit_text(get_text(await get_lang(uid), "global_sent", sent=sent, failed=failed))
-        context.application.bot_data.pop("pending_global", None)
+        if dead:
+            await mark_users_inactive(dead)
+            inactivos += len(dead)
+        if inactivos:
+            logger.info("📢 Difusión: %s usuarios marcados como inactivos", inactivos)
+        await msg.edit_text(get_text(await get_lang(uid), "global_sent", sent=sent, failed=failed, inactivos=inactivos))
+        state_pop(context.application.bot_data, "pending_global")
     else:
-        context.application.bot_data.pop("pending_global", None)
+        state_pop(context.application.bot_data, "pending_global")
         await query.edit_message_text("❌ Envío cancelado.")
 
 # ---------- admin menu callbacks router ------------
@@ -807,10 +1726,12 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await admin_responder_cb(update, context)
     elif data.startswith("global_confirm_"):
         await global_confirm_cb(update, context)
+    elif data.startswith("vp|"):
+        await ver_pedidos_nav_cb(update, context)
     elif data == "open_canal":
         canal = await config_get("canal_url")
-        if not canal and 'CANAL_USERNAME' in globals() and CANAL_USERNAME:
-            canal = CANAL_USERNAME
+        if not canal:
+            canal = bot_cfg().canal_username
         canal = canal or "https://t.me/tu_canal"
         try:
             await safe_answer(update.callback_query, url=canal)
@@ -828,24 +1749,22 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_answer(update.callback_query)
 
 # ------------- Admin set values via plain text --------------
-@require_channel_member
 async def admin_plain_text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
-    logger.info("admin_plain_text_router called: uid=%s chat=%s pending=%s", uid, getattr(update.effective_chat, 'id', None), bool(context.user_data.get('admin_pending')))
-    pending = context.user_data.get("admin_pending")
+    hot_logger.info("admin_plain_text_router called: uid=%s chat=%s pending=%s", uid, getattr(update.effective_chat, 'id', None), bool(state_get(context.user_data, 'admin_pending')))
+    pending = state_get(context.user_data, "admin_pending")
     if pending:
         action = pending.get("action")
-        logger.info("admin_plain_text_router: pending action=%s for uid=%s", action, uid)
+        hot_logger.info("admin_plain_text_router: pending action=%s for uid=%s", action, uid)
         if action == "global":
             text = update.message.text
-            context.application.bot_data["pending_global"] = {"text": text, "owner": uid}
-            logger.info("admin_plain_text_router: pending_global stored owner=%s len=%s", uid, len(text) if text else 0)
+            segmento = pending.get("segmento") or {}
+            state_set(context.application.bot_data, "pending_global", {"text": text, "owner": uid, "segmento": segmento})
+            hot_logger.info("admin_plain_text_router: pending_global stored owner=%s len=%s", uid, len(text) if text else 0)
             lang = await get_lang(uid)
-            await update.message.reply_text(get_text(lang, "global_confirm", n=len(await get_all_users())), reply_markup=kb_confirm_global()(lang))
-            # limpiar ambos lugares donde pudimos guardar el pending
-            context.user_data.pop("admin_pending", None)
-            context.application.bot_data.pop(f"admin_pending:{uid}", None)
+            await update.message.reply_text(get_text(lang, "global_confirm", n=await count_audiencia(**segmento)), reply_markup=kb_confirm_global()(lang))
+            state_pop(context.user_data, "admin_pending")
             return
         elif action == "reply":
             target = pending.get("target", {})
@@ -867,21 +1786,18 @@ async def admin_plain_text_router(update: Update, context: ContextTypes.DEFAULT_
             except Exception:
                 logger.exception("❌ Error enviando respuesta admin a usuario %s", target)
                 await update.message.reply_text("❌ No se pudo enviar la respuesta al usuario.")
-            # limpiar ambos lugares donde pudimos guardar el pending
-            context.user_data.pop("admin_pending", None)
-            context.application.bot_data.pop(f"admin_pending:{uid}", None)
+            state_pop(context.user_data, "admin_pending")
             return
 
 # ---------------- Support: admin reply handler (endurecido) -------------
-@require_channel_member
 async def admin_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if not chat:
         return
     admin_group = await config_get("admin_group")
     if not admin_group:
-        if 'ADMIN_GROUP_ID' in globals() and ADMIN_GROUP_ID:
-            admin_group = str(ADMIN_GROUP_ID)
+        if bot_cfg().admin_group_id:
+            admin_group = str(bot_cfg().admin_group_id)
         else:
             return
     try:
@@ -892,28 +1808,9 @@ async def admin_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     if not update.message.reply_to_message:
         return
-    replied_id = update.message.reply_to_message.message_id
-    rec = await soporte_get_by_admin_msg(replied_id)
-    user_id = None
-    if rec:
-        user_id = rec[1]
-    else:
-        import re
-        m = re.search(r"ID (\d+)", update.message.reply_to_message.text or "")
-        if m:
-            user_id = int(m.group(1))
-        txt = update.message.reply_to_message.text or ""
-        m = re.search(r"<code>(\d+)</code>", txt)
-        if m:
-            user_id = int(m.group(1))
-        else:
-            m = re.search(r"ID\s*[:#-]?\s*(\d+)", txt)
-            if m:
-                user_id = int(m.group(1))
-            else:
-                m = re.search(r"(\d{5,})", txt)
-                if m:
-                    user_id = int(m.group(1))
+    # solo la tabla de hilos: nunca se adivina el usuario a partir del texto
+    hilo = await hilo_get(chat.id, update.message.reply_to_message.message_id)
+    user_id = hilo[0] if hilo else None
     if not user_id:
         await update.message.reply_text("❌ No puedo encontrar a qué usuario corresponde este hilo.")
         return
@@ -935,7 +1832,7 @@ async def admin_responder_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await safe_answer(query)
     uid = query.from_user.id
     role = await get_role(uid)
-    if uid != OWNER_ID and role != "admin":
+    if uid != bot_cfg().owner_id and role != "admin":
         return await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
     data = query.data
     parts = data.split("_", 3)
@@ -947,35 +1844,95 @@ async def admin_responder_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info("admin_responder_cb: responder ticket=%s user_id=%s (admin=%s)", a, b, uid)
         ticket = a
         user_id = b
-        pending = {"action": "reply", "target": {"type": "ticket", "ticket": ticket, "user_id": user_id}}
-        context.user_data["admin_pending"] = pending
-        context.application.bot_data[f"admin_pending:{uid}"] = pending
+        pending = {"action": "reply", "target": {"type": "ticket", "ticket": ticket, "user_id": user_id}, "chat_id": uid}
+        state_set(context.user_data, "admin_pending", pending)
         try:
             await safe_send_message(context.bot, uid, "✍️ Escribe la respuesta que se enviará al usuario (responde a este mensaje):", reply_markup=ForceReply(selective=True))
             await query.edit_message_text((query.message.text or "") + "\n\n💬 Petición de respuesta enviada al admin en privado.")
         except Exception:
+            state_set(context.user_data, "admin_pending", {**pending, "chat_id": query.message.chat_id})
             logger.exception("No se pudo iniciar flujo de respuesta privada para admin %s", uid)
             await safe_answer(query, "❌ No pude enviar el mensaje privado. Intenta escribir la respuesta en este chat.")
     elif kind == "support":
         logger.info("admin_responder_cb: responder support user_id=%s user_msg_id=%s (admin=%s)", a, b, uid)
         user_id = a
         user_msg_id = b
-        pending = {"action": "reply", "target": {"type": "support", "user_id": user_id, "user_msg_id": user_msg_id}}
-        context.user_data["admin_pending"] = pending
-        context.application.bot_data[f"admin_pending:{uid}"] = pending
+        pending = {"action": "reply", "target": {"type": "support", "user_id": user_id, "user_msg_id": user_msg_id}, "chat_id": uid}
+        state_set(context.user_data, "admin_pending", pending)
         try:
             await safe_send_message(context.bot, uid, "✍️ Escribe la respuesta que se enviará al usuario (responde a este mensaje):", reply_markup=ForceReply(selective=True))
             await query.edit_message_text((query.message.text or "") + "\n\n💬 Petición de respuesta enviada al admin en privado.")
         except Exception:
+            state_set(context.user_data, "admin_pending", {**pending, "chat_id": query.message.chat_id})
             logger.exception("No se pudo iniciar flujo de respuesta privada para admin %s (support)", uid)
             await safe_answer(query, "❌ No pude enviar el mensaje privado. Intenta escribir la respuesta en este chat.")
 
+# ---------------- Dispatcher único de mensajes de texto ----------------
+# Precedencia cuando hay varios estados activos a la vez:
+#   1. En grupos, una respuesta (reply) va siempre a admin_reply_handler.
+#   2. admin_pending: el admin está escribiendo un mensaje global o una respuesta;
+#      solo cuenta en el chat donde se le pidió el texto (`chat_id`), para que
+#      sus mensajes normales en otros grupos no acaben enviados al usuario.
+#   3. pending_tipo: el usuario está escribiendo la descripción de un pedido.
+#   4. support_open: el usuario está en un chat de soporte (solo en privado).
+# Sin ningún estado activo el mensaje se ignora sin consultar nada más.
+# El tercer campo indica si la ruta exige ser miembro del canal; los flujos
+# de admin no lo necesitan porque solo se abren tras comprobar el rol.
+TEXT_ROUTES = (
+    ("admin_pending", admin_plain_text_router, False),
+    ("pending_tipo", recibir_pedido_msg, True),
+    ("support_open", soporte_user_msg, True),
+)
+PRIVATE_ONLY_STATES = {"pending_tipo", "support_open"}
+
+
+def _pending_in_chat(pending: dict, chat_type, chat_id) -> bool:
+    """admin_pending sin `chat_id` (versiones anteriores) solo vale en privado."""
+    if "chat_id" not in pending:
+        return chat_type == 'private'
+    return pending["chat_id"] == chat_id
+
+
+def resolve_text_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Devuelve (handler, requiere_canal) para el mensaje, o (None, False)."""
+    chat_type = getattr(update.effective_chat, 'type', None)
+    msg = update.effective_message
+    if chat_type != 'private' and getattr(msg, 'reply_to_message', None):
+        return admin_reply_handler, False
+    user_data = context.user_data
+    if user_data is None:
+        return None, False
+    chat_id = getattr(update.effective_chat, 'id', None)
+    for state_key, handler, needs_channel in TEXT_ROUTES:
+        if chat_type != 'private' and state_key in PRIVATE_ONLY_STATES:
+            continue
+        value = state_get(user_data, state_key)
+        if value is None:
+            continue
+        if state_key == "admin_pending" and not _pending_in_chat(value, chat_type, chat_id):
+            continue
+        return handler, needs_channel
+    return None, False
+
+
+async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler, needs_channel = resolve_text_route(update, context)
+    if handler is None:
+        return
+    if needs_channel and not await ensure_channel_member(update, context):
+        return
+    try:
+        return await handler(update, context)
+    except TimedOut:
+        logger.warning("Telegram request timed out in handler %s", handler.__name__)
+
+
 # ---------------- Close support by admin ----------------
 @require_channel_member
 async def admin_close_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     args = context.args
     if not args:
@@ -988,20 +1945,105 @@ async def admin_close_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Error: {e}")
 
 # ---------------- Misc admin commands ----------------
+# ---------------- /verpedidos paginado ----------------
+VERPEDIDOS_PAGE_SIZE = 10
+# códigos cortos para que callback_data quepa en los 64 bytes de Telegram
+_ESTADO_CODES = {"pending": "p", "in_progress": "i", "ready": "r", "cancelled": "c"}
+_TIPO_CODES = {"serie": "s", "pelicula": "p", "juego": "j", "otro": "o"}
+_ESTADO_BY_CODE = {v: k for k, v in _ESTADO_CODES.items()}
+_TIPO_BY_CODE = {v: k for k, v in _TIPO_CODES.items()}
+
+
+def parse_pedidos_filters(args) -> dict:
+    """Interpreta `estado=..`, `tipo=..`, `admin=..` o valores sueltos reconocibles."""
+    filtros = {"estado": None, "tipo": None, "admin_id": None}
+    for arg in args or []:
+        key, _, value = arg.partition("=")
+        if not value:
+            key, value = None, key
+        value = value.strip().lower()
+        if key in (None, "estado") and value in _ESTADO_CODES:
+            filtros["estado"] = value
+        elif key in (None, "tipo") and value in _TIPO_CODES:
+            filtros["tipo"] = value
+        elif key in (None, "admin") and value.isdigit():
+            filtros["admin_id"] = int(value)
+    return filtros
+
+
+def _pedidos_nav_data(filtros: dict, older: bool, cursor: tuple) -> str:
+    return "vp|{}|{}|{}|{}|{}|{}".format(
+        "n" if older else "p",
+        _ESTADO_CODES.get(filtros["estado"], ""),
+        _TIPO_CODES.get(filtros["tipo"], ""),
+        filtros["admin_id"] or "",
+        "" if cursor[0] is None else cursor[0], cursor[1],
+    )
+
+
+def _parse_pedidos_nav_data(data: str):
+    _, direction, estado, tipo, admin, ts, ticket = data.split("|", 6)
+    filtros = {
+        "estado": _ESTADO_BY_CODE.get(estado),
+        "tipo": _TIPO_BY_CODE.get(tipo),
+        "admin_id": int(admin) if admin else None,
+    }
+    return filtros, direction == "n", (int(ts) if ts else None, ticket)
+
+
+async def render_pedidos_page(lang: str, filtros: dict, cursor: tuple = None, older: bool = True):
+    rows, hay_mas = await get_pedidos_page(VERPEDIDOS_PAGE_SIZE, cursor, older, **filtros)
+    if not rows:
+        return None, None
+    header = get_text(lang, "verpedidos_title")
+    activos = [f"{k}={v}" for k, v in (("estado", filtros["estado"]), ("tipo", filtros["tipo"]), ("admin", filtros["admin_id"])) if v]
+    if activos:
+        header += " (" + ", ".join(activos) + ")"
+    lines = [header, ""]
+    for ticket, _, tipo, descripcion, fecha_ts, estado, _ in rows:
+        desc = html.escape((descripcion or "")[:100])
+        lines.append(f"🎟 <code>{ticket}</code> — {tipo} — {estado} — {fmt_ts(fecha_ts, '%d/%m %H:%M')}\n    {desc}")
+    # hay páginas más recientes si venimos de una o si la consulta hacia atrás encontró más
+    has_newer = hay_mas if not older else cursor is not None
+    has_older = hay_mas if older else True
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=_pedidos_nav_data(filtros, False, (rows[0][4], rows[0][0]))))
+    if has_older:
+        nav.append(InlineKeyboardButton("➡️", callback_data=_pedidos_nav_data(filtros, True, (rows[-1][4], rows[-1][0]))))
+    return "\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
+
+
 @require_private_chat
 @require_channel_member
 async def ver_pedidos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
-    rows = await get_pedidos(100)
-    if not rows:
+    filtros = parse_pedidos_filters(context.args)
+    text, kb = await render_pedidos_page(await get_lang(user.id), filtros)
+    if not text:
         return await update.message.reply_text("📭 No hay pedidos.")
-    text = get_text(await get_lang(user.id), "verpedidos_title") + "\n\n"
-    for r in rows:
-        text += f"🎟 <code>{r[0]}</code> — {r[2]} — {r[3][:120]}...\n"
-    await update.message.reply_text(text, parse_mode="HTML")
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=kb)
+
+
+@require_channel_member
+async def ver_pedidos_nav_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = query.from_user.id
+    role = await get_role(uid)
+    if uid != bot_cfg().owner_id and role != "admin":
+        return await safe_answer(query, "❌ No tienes permisos.", show_alert=True)
+    try:
+        filtros, older, cursor = _parse_pedidos_nav_data(query.data)
+    except Exception:
+        return await safe_answer(query, "❌ Parámetros inválidos.", show_alert=True)
+    text, kb = await render_pedidos_page(await get_lang(uid), filtros, cursor, older)
+    if not text:
+        return await safe_answer(query, "📭 No hay más pedidos.")
+    await safe_answer(query)
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
 
 
 @require_private_chat
@@ -1010,19 +2052,19 @@ async def stadistics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra estadísticas básicas: usuarios totales y admins."""
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
 
-    total = await count_users()
-    admins = await count_admins()
-    owners = 1 if 'OWNER_ID' in globals() and OWNER_ID else 0
-
-    # contar pedidos por estado
+    # contadores materializados: una sola lectura
     try:
-        estados = await count_pedidos_by_estado()
+        stats = await get_stats()
     except Exception:
-        logger.exception("❌ Error obteniendo conteos por estado")
-        estados = {}
+        logger.exception("❌ Error obteniendo estadísticas")
+        stats = {"usuarios": 0, "admins": 0, "estados": {}}
+    total = stats["usuarios"]
+    admins = stats["admins"]
+    estados = stats["estados"]
+    owners = 1 if bot_cfg().owner_id else 0
 
     lines = [f"📊 Estadísticas:", f"👥 Usuarios registrados: {total}", f"👤 Administradores: {admins}", f"👮🏻‍♂️ Dueños: {owners}", "🏷️ Pedidos por estado:"]
     for k in ("pending", "in_progress", "ready", "cancelled", "unknown"):
@@ -1032,6 +2074,24 @@ async def stadistics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if k not in ("pending", "in_progress", "ready", "cancelled", "unknown"):
             lines.append(f"  - {k}: {v}")
 
+    try:
+        analytics = await get_pedido_analytics(24)
+    except Exception:
+        logger.exception("❌ Error obteniendo analítica de pedidos")
+        analytics = None
+    if analytics:
+        ev = analytics["eventos"]
+        lines.append(f"📈 Últimas 24h: creados {ev.get('created', 0)}, tomados {ev.get('in_progress', 0)}, "
+                     f"listos {ev.get('ready', 0)}, cancelados {ev.get('cancelled', 0)}")
+        for metrica, label in (("take", "⏱ Hasta tomar"), ("ready", "⏱ Hasta listo")):
+            lat = analytics["latencias"].get(metrica) or {}
+            if lat.get("n"):
+                lines.append(f"{label}: mediana {_fmt_percentil(lat['p50'])}, p95 {_fmt_percentil(lat['p95'])} ({lat['n']} pedidos)")
+        if analytics["ready_por_tipo"]:
+            lines.append("📂 Listos por tipo (24h): " + ", ".join(f"{k or '?'} {v}" for k, v in sorted(analytics["ready_por_tipo"].items(), key=lambda kv: -kv[1])))
+        if analytics["ready_por_admin"]:
+            lines.append("🧑‍💼 Listos por admin (24h): " + ", ".join(f"{k}: {v}" for k, v in sorted(analytics["ready_por_admin"].items(), key=lambda kv: -kv[1])))
+
     await update.message.reply_text("\n".join(lines))
 
 @require_private_chat
@@ -1039,7 +2099,7 @@ async def stadistics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def ver_pedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /verpedido <TICKET>")
@@ -1047,7 +2107,7 @@ async def ver_pedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     row = await get_pedido(ticket)
     if not row:
         return await update.message.reply_text("❌ No encontrado.")
-    text = f"🎟 <code>{row[0]}</code>\n👤 {row[1]}\n📂 {row[2]}\n📝 {row[3]}\n🕒 {row[4]}"
+    text = f"🎟 <code>{row[0]}</code>\n👤 {row[1]}\n📂 {row[2]}\n📝 {row[3]}\n🕒 {fmt_ts(row[4])}"
     await update.message.reply_text(text, parse_mode="HTML")
 
 @require_private_chat
@@ -1055,7 +2115,7 @@ async def ver_pedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def buscopedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /buscopedido <texto>")
@@ -1073,7 +2133,7 @@ async def buscopedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def eliminarpedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /eliminarpedido <TICKET>")
@@ -1083,21 +2143,27 @@ async def eliminarpedido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return await update.message.reply_text(get_text(await get_lang(user.id), "eliminar_no", ticket=ticket), parse_mode="HTML")
     _, uid, tipo, descripcion, fecha = row
     try:
-        chat = await context.bot.get_chat(uid)
-        name = getattr(chat, 'username', None) or getattr(chat, 'first_name', None) or str(uid)
-        notify_text = f"🔴 Ey @{name}, tu pedido {ticket} de {tipo} fue eliminado por un administrador."
+        name = await user_mention(uid)
+        notify_text = f"🔴 Ey {name}, tu pedido {ticket} de {tipo} fue eliminado por un administrador."
         await safe_send_message(context.bot, uid, notify_text)
     except Exception:
         logger.exception("❌ No se pudo notificar al usuario %s sobre eliminación del pedido %s", uid, ticket)
+    for seg_ticket, seg_uid in await get_seguidores(ticket):
+        await safe_send_message(context.bot, seg_uid, f"🔴 Tu pedido {seg_ticket} de {tipo} fue eliminado por un administrador.")
 
+    estado = (await get_pedido_full(ticket) or {}).get('estado')
     await delete_pedido(ticket)
+    pedido_changed(ticket)
+    if estado == 'in_progress':
+        # sin transición que ajustar: se recalcula la carga desde la base
+        bot_cfg().scheduler.invalidate()
     await update.message.reply_text(get_text(await get_lang(user.id), "eliminar_ok", ticket=ticket), parse_mode="HTML")
 
 @require_private_chat
 @require_channel_member
 async def agregaradmin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id != OWNER_ID:
+    if user.id != bot_cfg().owner_id:
         return await update.message.reply_text("❌ Solo el dueño puede agregar admins.")
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /agregaradmin <user_id>")
@@ -1113,13 +2179,16 @@ async def agregaradmin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_channel_member
 async def eliminaradmin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id != OWNER_ID:
+    if user.id != bot_cfg().owner_id:
         return await update.message.reply_text("❌ Solo el dueño puede eliminar admins.")
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /eliminaradmin <user_id>")
     try:
         uid = int(context.args[0])
         await set_role(uid, "user")
+        # deja de recibir pedidos automáticos
+        if await unset_admin_disponible(uid):
+            bot_cfg().scheduler.invalidate()
         await update.message.reply_text(f"✅ Usuario {uid} ya no es admin.")
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {e}")
@@ -1142,28 +2211,28 @@ async def mispedidos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def pedidolisto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     if not context.args:
         return await update.message.reply_text("⚠️ Uso: /pedidolisto <TICKET>")
     ticket = context.args[0].strip()
-    row = await get_pedido(ticket)
-    if not row:
-        return await update.message.reply_text("❌ Ticket no encontrado.")
-    _, uid, tipo, descripcion, fecha = row
+    pedido = await transition_pedido(ticket, 'ready', user.id)
+    if not pedido:
+        return await update.message.reply_text("❌ Ticket no encontrado o ya cerrado.")
+    pedido_changed(ticket, pedido)
+    uid, tipo, descripcion = pedido['user_id'], pedido['tipo'], pedido['descripcion'] or ""
 
     try:
-        chat = await context.bot.get_chat(uid)
-        username = getattr(chat, 'username', None)
+        mention = await user_mention(uid)
     except Exception:
-        username = None
-
-    mention = f"@{username}" if username else str(uid)
-    notify_text = f"🟢 Ey {mention}, su pedido de {tipo} ('{descripcion[:80]}') ya está listo\n📌Grupo: @{GRUPO_USERNAME}"
+        mention = str(uid)
+    notify_text = f"🟢 Ey {mention}, su pedido de {tipo} ('{descripcion[:80]}') ya está listo\n📌Grupo: @{bot_cfg().grupo_username}"
 
     res = await safe_send_message(context.bot, uid, notify_text)
+    await notify_seguidores(context, pedido, lambda t: f"🟢 Tu pedido {t} de {tipo} ('{descripcion[:80]}') ya está listo\n📌Grupo: @{bot_cfg().grupo_username}")
 
     await delete_pedido(ticket)
+    pedido_changed(ticket)
 
     await update.message.reply_text(f"✅ Pedido {ticket} marcado como listo. Notificado al usuario: {'OK' if res else 'FALLÓ'}.")
 
@@ -1172,7 +2241,7 @@ async def pedidolisto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def exportar_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     role = await get_role(user.id)
-    if user.id != OWNER_ID and role != "admin":
+    if user.id != bot_cfg().owner_id and role != "admin":
         return await update.message.reply_text(get_text(await get_lang(user.id), "no_perms"))
     filename = f"bot_pedidos_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     await export_pedidos_csv(filename, 10000)
@@ -1190,7 +2259,7 @@ async def exportar_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_channel_member
 async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id != OWNER_ID:
+    if user.id != bot_cfg().owner_id:
         return await update.message.reply_text("❌ Solo el dueño puede crear backup.")
     p = await backup_db()
     await update.message.reply_text(get_text(await get_lang(user.id), "backup_done", path=p))
@@ -1199,57 +2268,415 @@ async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_channel_member
 async def chatadmin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    context.user_data["support_open"] = True
+    state_set(context.user_data, "support_open", True)
     await update.message.reply_text("✉️ Escribe tu mensaje y lo enviaremos a los administradores. Usa /cerrar para cerrar el chat.")
 
 @require_channel_member
 async def cerrar_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     await soporte_close_by_user(user.id)
-    context.user_data.pop("support_open", None)
+    state_pop(context.user_data, "support_open")
     await update.message.reply_text(get_text(await get_lang(user.id), "support_closed"))
 
 
 
-# --- Tarea periódica ---
-async def periodic_cleanup_task(application):
+# --- Mantenimiento programado (JobQueue) ---
+async def _mant_limpieza(cfg):
+    pedidos = await cleanup_old_pedidos(cfg["retencion_dias"])
+    eventos = await cleanup_old_eventos(cfg["eventos_dias"])
+    agregados = await cleanup_old_agregados(cfg["agregados_dias"])
+    logs = await cleanup_mantenimiento_log()
+    return f"pedidos={pedidos} eventos={eventos} agregados={agregados} log={logs}"
+
+
+async def _mant_soporte(cfg):
+    r = await soporte_compactar(STATE_TTLS["support_open"], cfg["soporte_dias"], cfg["soporte_meses"], cfg["hilos_dias"])
+    return (f"cerradas={r['cerradas']} archivadas={r['archivadas']} "
+            f"tablas_borradas={r['tablas_borradas']} hilos={r['hilos']}")
+
+
+async def _mant_optimize(cfg):
+    return await optimize_db()
+
+
+async def _mant_vacuum(cfg):
+    r = await incremental_vacuum(cfg["vacuum_paginas"])
+    if r["convertida"]:
+        return f"convertida a auto_vacuum=INCREMENTAL (libres {r['antes']} -> {r['despues']})"
+    return f"recuperadas {r['recuperadas']} páginas ({r['bytes'] // 1024} KiB), libres {r['despues']}"
+
+
+async def _mant_backup(cfg):
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    stem = os.path.splitext(os.path.basename(bot_cfg().db_path))[0]
+    path = await backup_db(os.path.join(cfg["backups_dir"], f"backup_{stem}_{stamp}.db"))
+    removed = rotate_backups(cfg["backups_dir"], cfg["backups_keep"])
+    return f"{path} (rotadas {len(removed)})"
+
+
+MAINTENANCE_TASKS = {
+    "limpieza": _mant_limpieza,
+    "soporte": _mant_soporte,
+    "optimize": _mant_optimize,
+    "vacuum": _mant_vacuum,
+    "backup": _mant_backup,
+}
+
+
+async def run_maintenance(tarea: str, force: bool = False):
+    """Ejecuta una tarea y registra duración y resultado en mantenimiento_log.
+
+    Sin `force`, se salta hasta que pasan sus `horas` desde la última ejecución
+    correcta (con hasta una hora de margen por la deriva del scheduler y los
+    cambios de horario): así una tarea de 168 h, que se programa a diario en la
+    ventana, solo corre una vez por semana.
+    """
+    cfg = MAINTENANCE
+    horas = cfg["tareas"].get(tarea)
+    if not force and horas:
+        last = await last_mantenimiento_ok(tarea)
+        if last and now_ts() - last < horas * 3600 - min(3600, horas * 1800):
+            return None
+    inicio, t0 = now_ts(), time.perf_counter()
+    try:
+        detalle = await MAINTENANCE_TASKS[tarea](cfg)
+        ok = True
+    except Exception as e:
+        logger.exception("❌ Error en la tarea de mantenimiento %s", tarea)
+        detalle, ok = f"{type(e).__name__}: {e}", False
+    duracion_ms = int((time.perf_counter() - t0) * 1000)
+    await log_mantenimiento(tarea, inicio, duracion_ms, ok, detalle)
+    logger.info("🧰 Mantenimiento %s: %s en %sms (%s)", tarea, "ok" if ok else "error", duracion_ms, detalle)
+    return ok
+
+
+_runtimes_by_app = {}
+
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    # los jobs corren desde el scheduler: se fija el bot y su base de forma explícita
+    activate_runtime(_runtimes_by_app.get(context.application, bot_cfg()))
+    await run_maintenance(context.job.data)
+
+
+async def schedule_maintenance(app):
+    """Programa cada tarea a una hora aleatoria dentro de la ventana y recupera las perdidas."""
+    jq = app.job_queue
+    if jq is None:
+        logger.warning("JobQueue no disponible (instala python-telegram-bot[job-queue]); sin mantenimiento programado")
+        return
+    cfg = MAINTENANCE
+    inicio, fin = (datetime.strptime(h, "%H:%M") for h in cfg["ventana"])
+    ventana = int((fin - inicio).total_seconds()) % 86400 or 3600
+    tz = datetime.now().astimezone().tzinfo
+    for tarea, horas in cfg["tareas"].items():
+        if tarea not in MAINTENANCE_TASKS:
+            logger.warning("Tarea de mantenimiento desconocida: %s", tarea)
+            continue
+        # jitter: cada tarea (y cada bot) a un minuto distinto de la ventana
+        hora = (inicio + timedelta(seconds=random.randrange(ventana))).time().replace(tzinfo=tz)
+        if horas >= 24:
+            # se dispara cada día en la ventana; run_maintenance salta los días que no tocan
+            jq.run_daily(maintenance_job, time=hora, data=tarea, name=f"mant_{tarea}")
+        else:
+            jq.run_repeating(maintenance_job, interval=horas * 3600, first=random.randrange(60, 600),
+                             data=tarea, name=f"mant_{tarea}")
+            continue
+        last = await last_mantenimiento_ok(tarea)
+        if not last or now_ts() - last > horas * 3600:
+            # ejecución perdida (reinicio o caída): recuperarla pronto, sin esperar a la ventana
+            jq.run_once(maintenance_job, when=random.randrange(60, 600), data=tarea, name=f"mant_{tarea}_catchup")
+        logger.info("🧰 Mantenimiento %s programado a las %s", tarea, hora.strftime("%H:%M"))
+
+
+async def mantenimiento_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id != bot_cfg().owner_id:
+        return await update.message.reply_text("❌ Solo el dueño puede ver el mantenimiento.")
+    if context.args:
+        tarea = context.args[0].lower()
+        if tarea not in MAINTENANCE_TASKS:
+            return await update.message.reply_text(f"⚠️ Uso: /mantenimiento [{' | '.join(MAINTENANCE_TASKS)}]")
+        await update.message.reply_text(f"🧰 Ejecutando {tarea}...")
+        await run_maintenance(tarea, force=True)
+    rows = await get_mantenimiento_log(15)
+    if not rows:
+        return await update.message.reply_text("ℹ️ Aún no hay tareas de mantenimiento registradas.")
+    lines = [
+        f"{'✅' if ok else '❌'} {fmt_ts(inicio, '%d/%m %H:%M')} <b>{tarea}</b> {dur}ms — {html.escape(detalle or '')}"
+        for tarea, inicio, dur, ok, detalle in rows
+    ]
+    await update.message.reply_text("🧰 Mantenimiento:\n" + "\n".join(lines), parse_mode="HTML")
+
+
+async def stats_reconcile_task(application, interval: int = 3600):
     while True:
         try:
-            await cleanup_old_pedidos(30)
-            await asyncio.sleep(86400)  # 24h
+            await asyncio.sleep(interval)
+            drift = await reconcile_stats()
+            if drift:
+                logger.warning("📊 Contadores desviados corregidos: %s", drift)
         except asyncio.CancelledError:
             break
         except Exception:
-            logger.exception("❌ Error en tarea periódica")
-            await asyncio.sleep(60)
+            logger.exception("❌ Error reconciliando estadísticas")
+
+async def state_sweep_task(application, interval: int = 60):
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            result = await sweep_conversation_state(application)
+            if result["expired"]:
+                logger.info("🧽 Estado de conversación caducado: %s", result)
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("❌ Error barriendo el estado de conversación")
+
+async def profile_flush_task(application, interval: int = 30):
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            await bot_cfg().profile_writer.flush()
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("❌ Error guardando perfiles de usuario")
+
+async def sla_watchdog_task(application):
+    rt = bot_cfg()
+    try:
+        for pedido in await get_pedidos_abiertos():
+            rt.sla.track_pedido(pedido)
+    except Exception:
+        logger.exception("❌ Error cargando los plazos SLA")
+    while True:
+        try:
+            await rt.sla.wait()
+            for deadline, ticket, estado in rt.sla.pop_due(time.time()):
+                await escalate_sla(application, ticket, estado)
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("❌ Error en el vigilante de SLA")
+            await asyncio.sleep(5)
+
+
+async def escalate_sla(application, ticket: str, estado: str):
+    # comprobación puntual por clave: el pedido pudo cerrarse por una vía sin aviso
+    pedido = await get_pedido_full(ticket)
+    if not pedido or (pedido.get('estado') or 'pending') != estado:
+        return
+    since = pedido.get('assigned_ts') if estado == 'in_progress' else pedido.get('fecha_ts')
+    limite = bot_cfg().sla.limits.get(estado)
+    text = (
+        f"⏰ <b>SLA superado</b>: <code>{ticket}</code> (#{html.escape(str(pedido.get('tipo')))})\n"
+        f"Lleva {fmt_duracion(now_ts() - (since or now_ts()))} en <b>{estado}</b> (límite {fmt_duracion(limite)})"
+    )
+    if pedido.get('assigned_admin_id'):
+        text += f"\n👤 Asignado a {html.escape(await user_mention(pedido['assigned_admin_id']))}"
+    dest = await config_get("admin_group") or bot_cfg().admin_group_id or bot_cfg().owner_id
+    try:
+        dest = int(dest)
+    except (TypeError, ValueError):
+        dest = bot_cfg().owner_id
+    if not dest:
+        return
+    logger.warning("SLA superado para %s en %s", ticket, estado)
+    await send_admin_thread(application.bot, dest, text, pedido.get('user_id'), "sla", ticket, parse_mode="HTML",
+                            reply_markup=kb_admin_actions(ticket, pedido.get('user_id')), critical=False)
+
 
 # --- Función de inicio que se ejecuta cuando el bot está listo ---
+async def migrate_hilos_task():
+    try:
+        gid = await config_get("admin_group") or bot_cfg().admin_group_id
+        migrated = await migrate_hilos(int(gid)) if gid else 0
+        if migrated:
+            logger.info("🧵 Hilos de soporte migrados: %s", migrated)
+    except Exception:
+        logger.exception("❌ Error migrando hilos de soporte")
+
+async def migrate_timestamps_task():
+    try:
+        migrated = await migrate_text_timestamps()
+        if migrated:
+            logger.info("🕒 Migradas %s fechas TEXT a epoch UTC.", migrated)
+    except Exception:
+        logger.exception("❌ Error migrando fechas a epoch")
+    try:
+        indexados = await backfill_trigramas()
+        if indexados:
+            logger.info("🔗 Indexados %s pedidos abiertos para detectar duplicados.", indexados)
+    except Exception:
+        logger.exception("❌ Error indexando trigramas de pedidos abiertos")
+
+
 async def on_startup(app):
     try:
-        app.create_task(periodic_cleanup_task(app))
-        logger.info("🧹 Tarea de limpieza periódica iniciada correctamente.")
+        app.create_task(migrate_timestamps_task())
+        app.create_task(stats_reconcile_task(app))
+        app.create_task(state_sweep_task(app))
+        app.create_task(profile_flush_task(app))
+        app.create_task(sla_watchdog_task(app))
+        app.create_task(error_digest_task(app, ERROR_DIGEST_INTERVAL))
+        await schedule_maintenance(app)
+        app.create_task(migrate_hilos_task())
+        logger.info("🧹 Tareas periódicas y mantenimiento iniciados correctamente.")
     except Exception as e:
         logger.error(f"⚠️ Error iniciando tarea periódica: {e}")
 
 
+async def metrics_observer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    bot_cfg().metrics.inc("updates")
+    user = update.effective_user
+    log_bind(update_id=update.update_id, user_id=user.id if user else None)
+
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id != bot_cfg().owner_id:
+        return await update.message.reply_text("❌ Solo el dueño puede ver las métricas.")
+    # solo las de este bot: cada comunidad ve sus propios datos
+    rt = bot_cfg()
+    lines = [f"{k}: {v}" for k, v in rt.metrics.snapshot().items()]
+    await update.message.reply_text(f"📈 Métricas de {rt.name}\n" + "\n".join(lines))
+
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id != bot_cfg().owner_id:
+        return await update.message.reply_text("❌ Solo el dueño puede perfilar el bot.")
+    try:
+        seconds = min(300, max(1, int(context.args[0]))) if context.args else 30
+    except ValueError:
+        return await update.message.reply_text("⚠️ Uso: /profile [segundos]")
+    await update.message.reply_text(
+        f"🔬 Perfilando {seconds}s (el bot sigue atendiendo)...\n"
+        "ℹ️ Solo se muestrea el event loop: la espera a SQLite cuenta como (idle); "
+        "ese tiempo está en las trazas (spans db.*)."
+    )
+    # la sesión va en una tarea aparte: el handler termina ya y los updates
+    # siguientes se procesan (y se miden) mientras se muestrea
+    context.application.create_task(
+        profile_session(context.bot, update.effective_chat.id, user.id, seconds, threading.get_ident()),
+        name=f"profile-{bot_cfg().name}",
+    )
+
+
+async def profile_session(bot, chat_id: int, user_id: int, seconds: int, loop_thread: int):
+    """Muestrea el hilo del event loop desde un executor y envía el informe al terminar."""
+    try:
+        prof = await asyncio.get_running_loop().run_in_executor(None, profile_thread, loop_thread, seconds)
+    except RuntimeError as e:
+        await safe_send_message(bot, chat_id, f"⚠️ {e}", critical=False)
+        return
+    await safe_send_message(bot, chat_id, f"<pre>{html.escape(prof.summary(12))}</pre>", parse_mode="HTML", critical=False)
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    await safe_send_document(
+        bot, user_id, prof.folded().encode("utf-8"), filename=f"profile_{bot_cfg().name}_{stamp}.folded.txt",
+        caption="Pilas colapsadas: flamegraph.pl o https://www.speedscope.app"
+    )
+
+
+async def metrics_log_task(runtimes, interval: int = 300):
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            for rt in runtimes:
+                logger.info("📈 [%s] %s", rt.name, rt.metrics.snapshot())
+        except asyncio.CancelledError:
+            break
+
+
 async def application_error_handler(update, context: ContextTypes.DEFAULT_TYPE):
+    bot_cfg().metrics.inc("errores")
+    err = context.error
+    mark_error(err)
     try:
-        logger.exception("Unhandled exception while processing update: %s", context.error)
+        key = bot_cfg().errors.record(err)
+        logger.error("Unhandled exception while processing update: %s", err, exc_info=err, extra={"huella": key})
     except Exception:
         logger.exception("Unhandled exception in error handler")
-    try:
-        if 'OWNER_ID' in globals() and OWNER_ID:
-            await safe_send_message(context.bot, OWNER_ID, f"⚠️ Error en bot: {getattr(context, 'error', 'unknown')}")
-    except Exception:
-        logger.exception("No se pudo notificar al OWNER_ID sobre la excepción")
+    # el owner recibe el resumen de error_digest_task, no un mensaje por excepción
 
-def main():
-    import asyncio as _asyncio
-    _asyncio.run(init_db())
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+
+async def error_digest_task(application, interval: int = 300):
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            rt = bot_cfg()
+            buckets = rt.errors.take_window()
+            if not buckets or not rt.owner_id:
+                continue
+            total = sum(b["ventana"] for b in buckets)
+            chunks = format_error_buckets(
+                buckets[:10], "ventana", f"⚠️ {total} errores en los últimos {interval // 60} min ({len(buckets)} tipos):",
+                footer=f"… y {len(buckets) - 10} tipos más (/errores)" if len(buckets) > 10 else None)
+            for text in chunks:
+                await safe_send_message(application.bot, rt.owner_id, text, parse_mode="HTML", critical=False)
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            logger.exception("❌ Error enviando el resumen de errores")
+
+
+async def errores_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id != bot_cfg().owner_id:
+        return await update.message.reply_text("❌ Solo el dueño puede ver los errores.")
+    errors = bot_cfg().errors
+    errors.prune()
+    buckets = sorted(errors.buckets.values(), key=lambda b: b["last"], reverse=True)
+    if not buckets:
+        return await update.message.reply_text("✅ Sin errores registrados.")
+    for text in format_error_buckets(buckets[:20], "total", "🧯 Errores (últimas 24 h):"):
+        await update.message.reply_text(text, parse_mode="HTML")
+
+
+def _update_attrs(update) -> dict:
+    """Atributos de la traza; nunca el texto del mensaje."""
+    attrs = {"bot": bot_cfg().name}
+    if not isinstance(update, Update):
+        return attrs
+    user = update.effective_user
+    attrs.update({"update_id": update.update_id, "user_id": user.id if user else None})
+    if update.callback_query:
+        attrs["callback"] = (update.callback_query.data or "").split("|")[0].split("_")[0][:32]
+    elif update.effective_message and isinstance(update.effective_message.text, str):
+        text = update.effective_message.text
+        attrs["command"] = text.split()[0].split("@")[0][:32] if text.startswith("/") else "(texto)"
+    return attrs
+
+
+class TracedApplication(Application):
+    """Application con una traza por update (span raíz 'update')."""
+
+    async def process_update(self, update: object) -> None:
+        if tracer is None:
+            return await super().process_update(update)
+        root = tracer.start("update", **_update_attrs(update))
+        try:
+            with root:
+                await super().process_update(update)
+        finally:
+            tracer.finish(root)
+
+
+def _trace_handlers(app):
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            cb = handler.callback
+            handler.callback = traced(f"handler.{getattr(cb, '__name__', 'callback')}")(cb)
+
+
+def register_handlers(app):
     app.add_error_handler(application_error_handler)
 
-    logger.info("Bot iniciado.")
+    # Métricas, perfil de usuario (solo memoria) y anti-flood: antes que cualquier otro handler
+    app.add_handler(TypeHandler(Update, metrics_observer), group=-3)
+    app.add_handler(TypeHandler(Update, profile_observer), group=-2)
+    app.add_handler(MessageHandler(filters.ALL, flood_guard), group=-1)
 
     # Commands
     app.add_handler(CommandHandler("start", start_handler))
@@ -1268,54 +2695,169 @@ def main():
     app.add_handler(CommandHandler("chatadmin", chatadmin_cmd))
     app.add_handler(CommandHandler("cerrar", cerrar_cmd))
     app.add_handler(CommandHandler("idioma", idioma_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
+    app.add_handler(CommandHandler("global", global_cmd))
+    app.add_handler(CommandHandler("disponible", disponible_cmd))
+    app.add_handler(CommandHandler("mantenimiento", mantenimiento_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
+    app.add_handler(CommandHandler("nodisponible", nodisponible_cmd))
+    app.add_handler(CommandHandler("errores", errores_cmd))
 
     # Messages
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_pedido_msg))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_plain_text_router))
-    app.add_handler(MessageHandler(filters.REPLY & filters.ChatType.GROUPS & filters.TEXT, admin_reply_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
+    _trace_handlers(app)
 
 
-    try:
-        import asyncio as _asyncio_internal
-        loop = _asyncio_internal.new_event_loop()
-        _asyncio_internal.set_event_loop(loop)
+class SharedHTTPPool:
+    """Un único httpx.AsyncClient (pool de conexiones) para todos los bots del proceso."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._client = None
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(connect=5.0, read=5.0, write=5.0, pool=1.0),
+                limits=httpx.Limits(max_connections=self.size, max_keepalive_connections=self.size),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest que usa el cliente del pool compartido; no lo cierra al apagar un bot."""
+
+    def __init__(self, pool: SharedHTTPPool):
+        self._pool = pool
+        super().__init__()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return self._pool.client()
+
+    async def shutdown(self) -> None:
+        return
+
+    async def do_request(self, url: str, *args, **kwargs):
+        # todas las peticiones a la Bot API, también las que no pasan por safe_*
+        with span(f"tg.{url.rsplit('/', 1)[-1]}") as s:
+            code, payload = await super().do_request(url, *args, **kwargs)
+            s.set(**{"http.status_code": code})
+            return code, payload
+
+
+async def startup_pipeline(app):
+    """post_init: fases de arranque en paralelo; deja el bot listo para app.start().
+
+    - esquema + cachés: init_db y después config/roles en memoria
+    - polling: start_polling borra el webhook (con reintentos) y empieza a
+      encolar updates; no se procesan hasta app.start(), con el esquema listo
+    """
+    rt = bot_cfg()
+    tiempos = {}
 
-        delete_ok = False
-        for attempt in range(3):
+    async def fase(nombre, coro):
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            tiempos[nombre] = round((time.perf_counter() - t0) * 1000)
+
+    async def esquema_y_caches():
+        await fase("esquema", init_db())
+        await fase("caches", warm_caches())
+
+    # se espera a las dos fases aunque una falle: si no, el polling podría
+    # arrancar después de que _serve_bot haya parado el updater
+    resultados = await asyncio.gather(
+        esquema_y_caches(), fase("webhook_polling", app.updater.start_polling()), return_exceptions=True
+    )
+    for r in resultados:
+        if isinstance(r, BaseException):
+            raise r
+    await fase("tareas", on_startup(app))
+    logger.info("🚀 [%s] fases de arranque (ms): %s", rt.name, tiempos)
+
+
+async def _serve_bot(rt: BotRuntime, pool: SharedHTTPPool, stop_event: asyncio.Event):
+    # cada bot corre en su propia tarea: el contexto (bot y base de datos) lo heredan
+    # todas las tareas que crea su Application
+    activate_runtime(rt)
+    t0 = time.perf_counter()
+    app = (
+        ApplicationBuilder()
+        .token(rt.token)
+        .application_class(TracedApplication)
+        .request(SharedHTTPXRequest(pool))
+        .get_updates_request(SharedHTTPXRequest(pool))
+        .persistence(SQLitePersistence(db_path=rt.db_path))
+        .post_init(startup_pipeline)
+        .build()
+    )
+    register_handlers(app)
+    _runtimes_by_app[app] = rt
+    async with app:
+        logger.info("🚀 [%s] initialize (getMe + persistencia): %.0f ms", rt.name, (time.perf_counter() - t0) * 1000)
+        try:
+            await app.post_init(app)
+            await app.start()
+            logger.info("Bot %s iniciado en %.0f ms (base %s).", rt.name, (time.perf_counter() - t0) * 1000, rt.db_path)
+            await stop_event.wait()
+        finally:
+            # también si falla el arranque: el polling empieza en post_init y, con el
+            # updater en marcha, app.shutdown() lanzaría RuntimeError tapando el error
+            # real y sin volcar la persistencia
+            if app.updater.running:
+                await app.updater.stop()
+            # lo que quedó acumulado desde el último flush periódico se perdería
             try:
-                resp = httpx.post(f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook", timeout=5.0)
-                if resp.status_code == 200:
-                    logger.info("Webhook eliminado o no existía (deleteWebhook ok).")
-                    delete_ok = True
-                    break
-                else:
-                    logger.warning("deleteWebhook returned %s: %s", resp.status_code, resp.text)
-            except (httpx.RequestError, OSError) as e:
-                logger.warning("Intento %s: No se pudo ejecutar deleteWebhook: %s", attempt + 1, e)
-            time.sleep(1 + attempt * 2)
-        if not delete_ok:
-            logger.warning("No se pudo eliminar webhook tras varios intentos; continuando con polling.")
-
-        max_restarts = 5
-        restarts = 0
-        while True:
+                await rt.profile_writer.flush()
+            except Exception:
+                logger.exception("❌ [%s] No se pudieron guardar los perfiles pendientes", rt.name)
+            if app.running:
+                await app.stop()
+    logger.info("Bot %s detenido.", rt.name)
+
+
+async def run_bots(runtimes: list):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    global tracer
+    if TRACING.get("enabled", True):
+        tracer = Tracer(**{k: v for k, v in TRACING.items() if k != "enabled"})
+    pool = SharedHTTPPool(size=max(8, 4 * len(runtimes)))
+    metrics_task = asyncio.create_task(metrics_log_task(runtimes))
+    tasks = [asyncio.create_task(_serve_bot(rt, pool, stop_event), name=f"bot-{rt.name}") for rt in runtimes]
+    try:
+        for task in asyncio.as_completed(tasks):
             try:
-                app.run_polling()
-                break
-            except KeyboardInterrupt:
-                logger.info("Bot detenido por teclado.")
-                raise
-            except (TimedOut, httpx.TimeoutException, httpx.RequestError, OSError) as e:
-                restarts += 1
-                logger.warning("Polling interrumpido por timeout/IO: %s. Reintentando (%s/%s)...", e, restarts, max_restarts)
-                if restarts >= max_restarts:
-                    logger.exception("Polling falló repetidamente por timeouts; abortando.")
-                    break
-                time.sleep(5)
-                continue
-            except Exception as e:
-                logger.exception(f"Error crítico en el polling: {e}")
-                break
+                await task
+            except Exception:
+                # un bot caído no tumba al resto
+                logger.exception("❌ Error crítico en un bot")
+    finally:
+        stop_event.set()
+        metrics_task.cancel()
+        await pool.aclose()
+        if tracer is not None:
+            # vacía la cola: los spans pendientes se escriben antes de salir
+            tracer.stop()
+            tracer = None
+
+
+def main():
+    runtimes = load_bot_configs()
+    logger.info("Iniciando %s bot(s) en un solo proceso.", len(runtimes))
+    try:
+        asyncio.run(run_bots(runtimes))
     except KeyboardInterrupt:
         logger.info("Bot detenido por teclado.")
     except Exception as e:
@@ -0,0 +1,192 @@
+# persistence.py
+import asyncio
+import json
+import logging
+
+import aiosqlite
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistencia de user_data, chat_data y bot_data en la base SQLite del bot.
+
+    Las llamadas update_* de PTB solo comparan con la última versión guardada
+    y marcan lo que cambió; las escrituras se agrupan en una única transacción
+    que se ejecuta `flush_delay` segundos después (write-behind). `flush()` lo
+    escribe todo de inmediato al apagar.
+    """
+
+    def __init__(self, db_path: str = None, update_interval: float = 10, flush_delay: float = 1.0):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self._db_path = db_path
+        self.flush_delay = flush_delay
+        self._tables_ready = False
+        # (tabla, clave) -> json guardado; sirve para no reescribir datos sin cambios
+        self._saved = {}
+        # (tabla, clave) -> json pendiente, o None para borrar
+        self._dirty = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def db_path(self) -> str:
+        return self._db_path or database.db_path()
+
+    async def _ensure_tables(self, db):
+        if self._tables_ready:
+            return
+        await db.execute("CREATE TABLE IF NOT EXISTS ptb_user_data (id INTEGER PRIMARY KEY, data TEXT)")
+        await db.execute("CREATE TABLE IF NOT EXISTS ptb_chat_data (id INTEGER PRIMARY KEY, data TEXT)")
+        await db.execute("CREATE TABLE IF NOT EXISTS ptb_bot_data (id INTEGER PRIMARY KEY, data TEXT)")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS ptb_conversations (
+                name TEXT,
+                key TEXT,
+                state TEXT,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID
+        """)
+        await db.commit()
+        self._tables_ready = True
+
+    async def _load_table(self, table: str) -> dict:
+        result = {}
+        async with aiosqlite.connect(self.db_path) as db:
+            await self._ensure_tables(db)
+            async with db.execute(f"SELECT id, data FROM {table}") as cur:
+                for key, raw in await cur.fetchall():
+                    try:
+                        result[key] = json.loads(raw)
+                        self._saved[(table, key)] = raw
+                    except ValueError:
+                        logger.warning("Datos persistidos ilegibles en %s para %s; se descartan", table, key)
+        return result
+
+    # ---------- carga al arrancar ----------
+    async def get_user_data(self):
+        return await self._load_table("ptb_user_data")
+
+    async def get_chat_data(self):
+        return await self._load_table("ptb_chat_data")
+
+    async def get_bot_data(self):
+        return (await self._load_table("ptb_bot_data")).get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        result = {}
+        async with aiosqlite.connect(self.db_path) as db:
+            await self._ensure_tables(db)
+            async with db.execute("SELECT key, state FROM ptb_conversations WHERE name=?", (name,)) as cur:
+                for key, state in await cur.fetchall():
+                    result[tuple(json.loads(key))] = json.loads(state)
+                    self._saved[("ptb_conversations", (name, key))] = state
+        return result
+
+    # ---------- marcado de cambios ----------
+    def _mark(self, table: str, key, data):
+        try:
+            raw = None if data is None else json.dumps(data, separators=(",", ":"), sort_keys=True)
+        except (TypeError, ValueError):
+            logger.exception("❌ No se pueden serializar los datos de %s para %s", table, key)
+            return
+        if raw is not None and self._saved.get((table, key)) == raw:
+            self._dirty.pop((table, key), None)
+            return
+        if raw is None and (table, key) not in self._saved:
+            self._dirty.pop((table, key), None)
+            return
+        self._dirty[(table, key)] = raw
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        self._mark("ptb_user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        self._mark("ptb_chat_data", chat_id, data)
+
+    async def update_bot_data(self, data) -> None:
+        self._mark("ptb_bot_data", 0, data)
+
+    async def update_callback_data(self, data) -> None:
+        return
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._mark("ptb_conversations", (name, json.dumps(list(key))), new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark("ptb_user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark("ptb_chat_data", chat_id, None)
+
+    # los datos solo los modifica este proceso: no hay nada que refrescar
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        return
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        return
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        return
+
+    # ---------- escritura diferida ----------
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.flush_delay)
+            await self._write_dirty()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("❌ Error escribiendo la persistencia")
+
+    async def _write_dirty(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                await self._write(dirty)
+            except Exception:
+                # se reintenta en la siguiente escritura; lo más reciente tiene prioridad
+                self._dirty = {**dirty, **self._dirty}
+                raise
+            for entry, raw in dirty.items():
+                if raw is None:
+                    self._saved.pop(entry, None)
+                else:
+                    self._saved[entry] = raw
+
+    async def _write(self, dirty: dict):
+        async with aiosqlite.connect(self.db_path) as db:
+            await self._ensure_tables(db)
+            for (table, key), raw in dirty.items():
+                if table == "ptb_conversations":
+                    if raw is None:
+                        await db.execute("DELETE FROM ptb_conversations WHERE name=? AND key=?", key)
+                    else:
+                        await db.execute(
+                            "INSERT INTO ptb_conversations (name, key, state) VALUES (?, ?, ?) "
+                            "ON CONFLICT(name, key) DO UPDATE SET state=excluded.state",
+                            (*key, raw)
+                        )
+                elif raw is None:
+                    await db.execute(f"DELETE FROM {table} WHERE id=?", (key,))
+                else:
+                    await db.execute(
+                        f"INSERT INTO {table} (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data=excluded.data",
+                        (key, raw)
+                    )
+            await db.commit()
+
+    async def flush(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_dirty()
@@ -0,0 +1,107 @@
+# profiler.py
+import collections
+import os
+import sys
+import threading
+import time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_IDLE_FUNCS = {"select", "poll", "epoll", "_run_once"}
+_LOOP_ENTRY = "asyncio/events.py:_run"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    path = os.path.abspath(code.co_filename)
+    if path.startswith(_HERE):
+        name = os.path.basename(path)
+    else:
+        # paquetes externos: basta con paquete/archivo
+        parts = path.replace("\\", "/").split("/")
+        name = "/".join(parts[-2:])
+    return f"{name}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Muestrea la pila de un hilo (el del event loop) desde otro hilo.
+
+    No instrumenta nada: cada `interval` segundos lee sys._current_frames(),
+    así que el coste para el bot es mínimo y se puede activar en caliente.
+    Las corrutinas en ejecución aparecen en la pila del hilo con sus llamadores
+    (p. ej. callback_router -> admin_take_cb); cuando el loop espera en select()
+    la muestra cuenta como "(idle)". Eso incluye las consultas SQLite: aiosqlite
+    las ejecuta en su propio hilo, así que su tiempo no se atribuye aquí; se ve
+    en los spans db.* de las trazas (tracing.py).
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005, max_depth: int = 64):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.duration = 0.0
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        if stack and stack[-1].rsplit(":", 1)[-1] in _IDLE_FUNCS:
+            stack = ["(idle)"]
+        elif _LOOP_ENTRY in stack:
+            # lo que hay por encima del callback del loop es igual en todas las muestras
+            stack = stack[len(stack) - stack[::-1].index(_LOOP_ENTRY):]
+        self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def run(self, seconds: float):
+        """Bloquea el hilo que lo llama durante `seconds`; usar desde un executor."""
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            self._sample()
+            time.sleep(self.interval)
+        self.duration = time.perf_counter() - start
+        return self
+
+    def folded(self) -> str:
+        """Formato 'pila;colapsada N' de flamegraph.pl / speedscope."""
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    def summary(self, top: int = 15) -> str:
+        total = collections.Counter()
+        own = collections.Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for f in set(frames):
+                total[f] += n
+        busy = self.samples - self.stacks.get("(idle)", 0)
+        lines = [
+            f"Muestras: {self.samples} en {self.duration:.1f}s (cada {self.interval * 1000:.0f}ms)",
+            f"Loop ocupado: {100 * busy / max(1, self.samples):.1f}%",
+            "",
+            "Tiempo acumulado (función y lo que llama):",
+        ]
+        lines += [f"  {100 * n / max(1, self.samples):5.1f}%  {f}" for f, n in total.most_common(top) if f != "(idle)"]
+        lines += ["", "Tiempo propio:"]
+        lines += [f"  {100 * n / max(1, self.samples):5.1f}%  {f}" for f, n in own.most_common(top)]
+        return "\n".join(lines) + "\n"
+
+
+_lock = threading.Lock()
+
+
+def profile_thread(thread_id: int, seconds: float, interval: float = 0.005) -> SamplingProfiler:
+    """Perfila `thread_id`; solo una sesión a la vez por proceso."""
+    if not _lock.acquire(blocking=False):
+        raise RuntimeError("Ya hay un perfilado en curso")
+    try:
+        return SamplingProfiler(thread_id, interval).run(seconds)
+    finally:
+        _lock.release()
@@ -0,0 +1,110 @@
+# Compactación de la tabla soporte: cierre por inactividad, archivo mensual y retención
+import asyncio
+import time
+
+import aiosqlite
+import pytest
+
+import database
+from database import soporte_compactar, soporte_registrar_mensaje
+
+DIA = 86400
+
+
+@pytest.fixture
+def db(tmp_path):
+    token = database.use_db(str(tmp_path / "test.db"))
+    asyncio.run(database.init_db())
+    yield database.db_path()
+    database._db_path_var.reset(token)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _insert(db, user_id, estado, fecha_ts, ultimo_ts=None, cerrado_ts=None):
+    async with aiosqlite.connect(db) as conn:
+        await conn.execute(
+            "INSERT INTO soporte (user_id, estado, fecha_ts, ultimo_ts, cerrado_ts) VALUES (?, ?, ?, ?, ?)",
+            (user_id, estado, fecha_ts, ultimo_ts, cerrado_ts)
+        )
+        await conn.commit()
+
+
+async def _query(db, sql, params=()):
+    async with aiosqlite.connect(db) as conn:
+        async with conn.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+
+def _archivos(db):
+    rows = _run(_query(db, "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'soporte_archivo_%'"))
+    return sorted(name for (name,) in rows)
+
+
+def _mes(ts):
+    return time.strftime("%Y%m", time.gmtime(ts))
+
+
+def test_sesiones_recientes_y_abiertas_se_quedan(db):
+    _run(soporte_registrar_mensaje(1, 10, 100))
+    now = int(time.time())
+    _run(_insert(db, 2, "closed", now - DIA, now - DIA, now - DIA))
+    r = _run(soporte_compactar(1800, retencion_dias=7))
+    assert r["cerradas"] == 0 and r["archivadas"] == 0
+    assert _run(_query(db, "SELECT user_id, estado FROM soporte ORDER BY user_id")) == [(1, "open"), (2, "closed")]
+    assert _archivos(db) == []
+
+
+def test_archiva_por_mes_de_cierre(db):
+    now = int(time.time())
+    viejo = now - 20 * DIA
+    _run(_insert(db, 1, "closed", viejo, viejo, viejo))
+    r = _run(soporte_compactar(1800, retencion_dias=7))
+    assert r["archivadas"] == 1
+    assert _run(_query(db, "SELECT COUNT(*) FROM soporte")) == [(0,)]
+    tabla = f"soporte_archivo_{_mes(viejo)}"
+    assert _archivos(db) == [tabla]
+    assert _run(_query(db, f"SELECT user_id, cerrado_ts FROM {tabla}")) == [(1, viejo)]
+
+
+def test_cierra_inactivas_y_las_archiva_tras_la_retencion(db):
+    now = int(time.time())
+    _run(_insert(db, 1, "open", now - 30 * DIA, now - 30 * DIA))
+    r = _run(soporte_compactar(1800, retencion_dias=7))
+    assert r["cerradas"] == 1 and r["archivadas"] == 1
+    assert _run(_query(db, "SELECT COUNT(*) FROM soporte")) == [(0,)]
+
+
+def test_filas_heredadas_sin_cerrado_ts(db):
+    now = int(time.time())
+    _run(_insert(db, 1, "closed", now - 400 * DIA))
+    _run(_insert(db, 2, "closed", None))
+    _run(soporte_compactar(1800, retencion_dias=7, meses_archivo=24))
+    # la antigua se archiva; la que no tiene fecha cuenta como cerrada ahora
+    assert _run(_query(db, "SELECT user_id FROM soporte")) == [(2,)]
+    assert _archivos(db) == [f"soporte_archivo_{_mes(now - 400 * DIA)}"]
+
+
+def test_borra_archivos_fuera_de_retencion(db):
+    now = int(time.time())
+    _run(_insert(db, 1, "closed", now - 400 * DIA, now - 400 * DIA, now - 400 * DIA))
+    _run(_insert(db, 2, "closed", now - 40 * DIA, now - 40 * DIA, now - 40 * DIA))
+    r = _run(soporte_compactar(1800, retencion_dias=7, meses_archivo=12))
+    assert r["archivadas"] == 2
+    assert r["tablas_borradas"] == 1
+    assert _archivos(db) == [f"soporte_archivo_{_mes(now - 40 * DIA)}"]
+
+
+def test_poda_hilos_antiguos(db):
+    now = int(time.time())
+    _run(database.hilo_register(-100, 1, 42, "pedido", "T1"))
+    async def envejecer():
+        async with aiosqlite.connect(db) as conn:
+            await conn.execute("INSERT INTO hilos VALUES (-100, 2, 43, 'soporte', NULL, ?)", (now - 200 * DIA,))
+            await conn.commit()
+    _run(envejecer())
+    r = _run(soporte_compactar(1800, hilos_dias=90))
+    assert r["hilos"] == 1
+    assert _run(_query(db, "SELECT admin_msg_id FROM hilos")) == [(1,)]
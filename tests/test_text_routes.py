@@ -0,0 +1,85 @@
+# Precedencia del dispatcher de texto (ver TEXT_ROUTES en main.py)
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import resolve_text_route, state_set
+
+
+ADMIN = 42
+GRUPO = -100123
+
+
+def _update(chat_type="private", reply=False, chat_id=None):
+    if chat_id is None:
+        chat_id = ADMIN if chat_type == "private" else GRUPO
+    msg = SimpleNamespace(reply_to_message=SimpleNamespace(message_id=1) if reply else None)
+    return SimpleNamespace(effective_chat=SimpleNamespace(type=chat_type, id=chat_id), effective_message=msg)
+
+
+def _context(**states):
+    user_data = {}
+    for key, value in states.items():
+        state_set(user_data, key, value)
+    return SimpleNamespace(user_data=user_data)
+
+
+def test_sin_estado_no_hay_ruta():
+    assert resolve_text_route(_update(), _context()) == (None, False)
+
+
+def test_sin_user_data_no_hay_ruta():
+    assert resolve_text_route(_update(), SimpleNamespace(user_data=None)) == (None, False)
+
+
+def test_reply_en_grupo_gana_a_admin_pending():
+    ctx = _context(admin_pending={"action": "global"})
+    assert resolve_text_route(_update("supergroup", reply=True), ctx) == (main.admin_reply_handler, False)
+
+
+def test_reply_en_privado_no_es_respuesta_de_admin():
+    ctx = _context(admin_pending={"action": "global"})
+    assert resolve_text_route(_update("private", reply=True), ctx) == (main.admin_plain_text_router, False)
+
+
+@pytest.mark.parametrize("states, esperado", [
+    ({"admin_pending": {"action": "global"}, "pending_tipo": "serie", "support_open": True},
+     (main.admin_plain_text_router, False)),
+    ({"pending_tipo": "serie", "support_open": True}, (main.recibir_pedido_msg, True)),
+    ({"support_open": True}, (main.soporte_user_msg, True)),
+])
+def test_precedencia_en_privado(states, esperado):
+    assert resolve_text_route(_update(), _context(**states)) == esperado
+
+
+@pytest.mark.parametrize("chat_type", ["group", "supergroup"])
+def test_estados_privados_se_ignoran_en_grupos(chat_type):
+    ctx = _context(pending_tipo="serie", support_open=True)
+    assert resolve_text_route(_update(chat_type), ctx) == (None, False)
+
+
+def test_admin_pending_funciona_en_el_grupo_donde_se_pidio():
+    ctx = _context(admin_pending={"action": "global", "chat_id": GRUPO}, pending_tipo="serie")
+    assert resolve_text_route(_update("group"), ctx) == (main.admin_plain_text_router, False)
+
+
+@pytest.mark.parametrize("chat_type, chat_id", [("group", GRUPO), ("supergroup", -100999), ("private", 7)])
+def test_admin_pending_privado_no_captura_otros_chats(chat_type, chat_id):
+    pending = {"action": "reply", "target": {"type": "ticket", "ticket": "T1", "user_id": "7"}, "chat_id": ADMIN}
+    ctx = _context(admin_pending=pending)
+    assert resolve_text_route(_update(chat_type, chat_id=chat_id), ctx) == (None, False)
+    assert resolve_text_route(_update(), ctx) == (main.admin_plain_text_router, False)
+
+
+def test_admin_pending_sin_chat_id_solo_en_privado():
+    ctx = _context(admin_pending={"action": "global"})
+    assert resolve_text_route(_update("group"), ctx) == (None, False)
+    assert resolve_text_route(_update(), ctx) == (main.admin_plain_text_router, False)
+
+
+def test_estado_caducado_no_cuenta():
+    ctx = _context(pending_tipo="serie", support_open=True)
+    ctx.user_data[main._EXP_KEY]["pending_tipo"] = time.time() - 1
+    assert resolve_text_route(_update(), ctx) == (main.soporte_user_msg, True)
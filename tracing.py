@@ -0,0 +1,160 @@
+# tracing.py
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+# Traza del update en curso y span activo; cada tarea ve los suyos
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return os.urandom(nbytes).hex()
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "error", "attrs")
+
+    def __init__(self, **attrs):
+        self.trace_id = _new_id(16)
+        self.spans = []
+        self.error = False
+        self.attrs = attrs
+
+
+class Span:
+    """Mide un bloque dentro de la traza actual; sin traza activa no hace nada."""
+
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "start_ns", "end_ns", "error", "_trace", "_token")
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self._trace = None
+        self.error = None
+
+    def __enter__(self):
+        self._trace = _current_trace.get()
+        if self._trace is None:
+            return self
+        self.span_id = _new_id(8)
+        self.parent_id = _current_span.get()
+        self._token = _current_span.set(self.span_id)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._trace is None:
+            return False
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self.error = f"{exc_type.__name__}: {exc}"
+        self._trace.spans.append(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_otel(self, trace: Trace, resource: dict) -> dict:
+        return {
+            "resource": resource,
+            "traceId": trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attrs,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+def span(name: str, **attrs) -> Span:
+    return Span(name, **attrs)
+
+
+def traced(name: str = None):
+    """Decorador para corrutinas: un span por llamada."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with Span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_module(module, prefix: str):
+    """Envuelve con `traced` todas las corrutinas públicas definidas en `module`."""
+    for attr, func in list(vars(module).items()):
+        if (not attr.startswith("_") and inspect.iscoroutinefunction(func)
+                and func.__module__ == module.__name__):
+            setattr(module, attr, traced(f"{prefix}.{attr}")(func))
+
+
+def mark_error(exc: BaseException):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.error = True
+        trace.attrs.setdefault("error", f"{type(exc).__name__}: {exc}")
+
+
+class Tracer:
+    """Crea una traza por update y exporta, con muestreo de cola, las que interesan.
+
+    Se guardan siempre las trazas con error o más lentas que `slow_ms`, y una
+    fracción `sample_rate` del resto. Cada span es una línea JSON con la forma
+    de OpenTelemetry (traceId/spanId/parentSpanId, tiempos en ns); el archivo
+    rota por tamaño y se escribe desde un hilo aparte.
+    """
+
+    def __init__(self, path: str = "traces.jsonl", max_bytes: int = 10 * 1024 * 1024, backups: int = 5,
+                 sample_rate: float = 0.01, slow_ms: float = 1000, service: str = "bot-pedidos"):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.service = service
+        self._queue = queue.SimpleQueue()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._listener.start()
+
+    def start(self, name: str, **attrs):
+        """Abre la traza y su span raíz; devuelve el span para usarlo con `with`."""
+        _current_trace.set(Trace(**attrs))
+        _current_span.set(None)
+        return Span(name, **attrs)
+
+    def finish(self, root: Span):
+        trace = _current_trace.get()
+        _current_trace.set(None)
+        if trace is None or not trace.spans:
+            return False
+        dur_ms = (root.end_ns - root.start_ns) / 1e6 if root._trace is not None else 0
+        keep = trace.error or root.error or dur_ms >= self.slow_ms or random.random() < self.sample_rate
+        if not keep:
+            return False
+        resource = {"service.name": self.service, **{k: v for k, v in trace.attrs.items() if k == "bot"}}
+        for s in trace.spans:
+            line = json.dumps(s.to_otel(trace, resource), ensure_ascii=False, default=str)
+            self._queue.put_nowait(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+        return True
+
+    def stop(self):
+        """Escribe lo que quede en la cola y cierra el archivo."""
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()